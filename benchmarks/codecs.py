@@ -0,0 +1,125 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Packet serialization and parsing, checksums, callsign validation and DVTool files.
+# Run from the top-level directory with: python -m benchmarks.runner -s codecs
+
+import cStringIO
+
+from pydv.dstar import DSTARCallsign, DSTARSuffix, DSTARModule, DSTARHeader, DSTARFrame
+from pydv.crc import CCITTChecksum
+from pydv.stream import DVHeaderPacket, DVFramePacket
+from pydv.dextra import DExtraConnectPacket, DExtraConnectAckPacket, DExtraConnectNackPacket, DExtraDisconnectPacket, \
+                        DExtraDisconnectAckPacket, DExtraKeepAlivePacket
+from pydv.dplus import DPlusConnectPacket, DPlusLoginPacket, DPlusLoginOKPacket, DPlusLoginBusyPacket, DPlusLoginFailPacket, \
+                       DPlusDisconnectPacket, DPlusKeepAlivePacket, DPlusHeaderPacket, DPlusFramePacket
+from pydv.ambed import AMBEdCodec, AMBEdOpenStreamPacket, AMBEdStreamDescriptorPacket, AMBEdBusyPacket, AMBEdCloseStreamPacket, \
+                       AMBEdPingPacket, AMBEdPongPacket, AMBEdFrameInPacket, AMBEdFrameOutPacket
+from pydv.dvtool import DVToolFile
+
+def _header():
+    return DSTARHeader(0, 0, 0,
+                       DSTARCallsign('XRF999 A'),
+                       DSTARCallsign('XRF999 G'),
+                       DSTARCallsign('CQCQCQ  '),
+                       DSTARCallsign('SV9OAN  '),
+                       DSTARSuffix('    '))
+
+def _frame(packet_id=0):
+    return DVFramePacket(0, 0, 0, 0x1234, packet_id, DSTARFrame('\x9e\x8d\x32\x88\x26\x1a\x3f\x61\xe8', '\x55\x2d\x16'))
+
+def sample_stream(frames=100):
+    # A header followed by frames, the last one marked as such
+    stream = [DVHeaderPacket(0, 0, 0, 0x1234, _header())]
+    for i in xrange(frames):
+        stream.append(_frame((i % 21) | (64 if i == frames - 1 else 0)))
+    return stream
+
+def sample_packets():
+    callsign = DSTARCallsign('SV9OAN')
+    reflector_callsign = DSTARCallsign('XRF999')
+    return [DVHeaderPacket(0, 0, 0, 0x1234, _header()),
+            _frame(),
+            DExtraConnectPacket(callsign, DSTARModule('B'), DSTARModule('A'), 1),
+            DExtraConnectAckPacket(callsign, DSTARModule('B'), DSTARModule('A'), 1),
+            DExtraConnectNackPacket(callsign, DSTARModule('B'), DSTARModule('A')),
+            DExtraDisconnectPacket(callsign, DSTARModule('B')),
+            DExtraDisconnectAckPacket(),
+            DExtraKeepAlivePacket(reflector_callsign),
+            DPlusConnectPacket(),
+            DPlusLoginPacket(callsign, 'DV019999'),
+            DPlusLoginOKPacket(),
+            DPlusLoginBusyPacket(),
+            DPlusLoginFailPacket(),
+            DPlusDisconnectPacket(),
+            DPlusKeepAlivePacket(),
+            DPlusHeaderPacket(DVHeaderPacket(0, 0, 0, 0x1234, _header())),
+            DPlusFramePacket(_frame()),
+            DPlusFramePacket(_frame(64)), # Last frames are framed differently
+            AMBEdOpenStreamPacket(callsign, AMBEdCodec.AMBEPLUS, AMBEdCodec.CODEC2_3200),
+            AMBEdStreamDescriptorPacket(1, 10101, AMBEdCodec.AMBEPLUS, AMBEdCodec.CODEC2_3200),
+            AMBEdBusyPacket(),
+            AMBEdCloseStreamPacket(1),
+            AMBEdPingPacket(callsign),
+            AMBEdPongPacket(),
+            AMBEdFrameInPacket(0, AMBEdCodec.AMBEPLUS, '\x9e\x8d\x32\x88\x26\x1a\x3f\x61\xe8'),
+            AMBEdFrameOutPacket(0, AMBEdCodec.AMBEPLUS, AMBEdCodec.CODEC2_3200, '\x9e\x8d\x32\x88\x26\x1a\x3f\x61\xe8', '\x00' * 9)]
+
+def _read_dvtool(data):
+    with DVToolFile('benchmark', cStringIO.StringIO(data)) as f:
+        return f.read()
+
+def _write_dvtool(stream):
+    with DVToolFile('benchmark', cStringIO.StringIO()) as f:
+        f.write(stream)
+
+def benchmarks():
+    # (name, function, operations per call)
+    result = []
+    names = set()
+    for packet in sample_packets():
+        cls = packet.__class__
+        name = cls.__name__
+        if name in names:
+            name += '(last)'
+        names.add(name)
+        data = packet.to_data()
+        result.append(('packet/%s/to_data' % name, packet.to_data, 1))
+        result.append(('packet/%s/from_data' % name, lambda cls=cls, data=data: cls.from_data(data), 1))
+
+    header_data = _header().to_data()[:39]
+    def checksum():
+        crc = CCITTChecksum()
+        crc.update(header_data)
+        return crc.result()
+    result.append(('crc/ccitt/header', checksum, 1))
+
+    result.append(('callsign/valid', lambda: DSTARCallsign('SV9OAN  '), 1))
+    def invalid_callsign():
+        try:
+            DSTARCallsign('SV9-OAN')
+        except ValueError:
+            pass
+    result.append(('callsign/invalid', invalid_callsign, 1))
+
+    stream = sample_stream(500) # 10 seconds
+    f = cStringIO.StringIO()
+    with DVToolFile('benchmark', f) as dvtool:
+        dvtool.write(stream)
+    data = f.getvalue()
+    result.append(('dvtool/read', lambda: _read_dvtool(data), len(stream)))
+    result.append(('dvtool/write', lambda: _write_dvtool(stream), len(stream)))
+    return result
@@ -0,0 +1,339 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# End-to-end load test of the client stack. For each number of streams, stand-in reflectors are started in
+# another process, and each stream gets a talker and a listener connection (DExtraConnection or DPlusConnection)
+# in a room of its own: a DExtraReflector module, or a DPlus stand-in that relays everything between its peers.
+# Talkers transmit at 50 frames/s, paced by a single clock, with optional loss, reordering and jitter.
+# Run from the top-level directory with: python -m benchmarks.load [-p dplus] [-n 1,2,4,8,16,32] [-i file.dvtool]
+
+import os
+import sys
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import string
+import threading
+import time
+
+from pydv.dstar import DSTARCallsign, DSTARSuffix, DSTARModule, DSTARHeader, DSTARFrame
+from pydv.stream import DVHeaderPacket, DVFramePacket
+from pydv.dextra import DExtraConnection
+from pydv.dplus import DPlusConnectPacket, DPlusLoginOKPacket, DPlusDisconnectPacket, DPlusKeepAlivePacket, DPlusConnection
+from pydv.network import NetworkAddress, UDPServerSocket
+from pydv.reflector import DExtraReflector
+from pydv.dvtool import DVToolFile
+from pydv.metrics import Histogram
+from pydv.timer import scheduler
+from pydv.utils import StoppableThread, monotonic
+
+FRAME_PERIOD = 0.020
+SILENCE = DSTARFrame('\x9e\x8d\x32\x88\x26\x1a\x3f\x61\xe8', '\x55\x2d\x16')
+
+class DPlusStandIn(StoppableThread):
+    # Accepts DPlus links and relays voice packets to all other linked peers (a single room)
+    def __init__(self, address, keepalive_period=1):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        StoppableThread.__init__(self, name=self.__class__.__name__)
+        self._sleep_period = 0
+        self.daemon = True
+
+        self.sock = UDPServerSocket(address)
+        self.address = address
+        self.keepalive_period = keepalive_period
+        self.last_keepalive = 0
+
+    def __enter__(self):
+        self.sock.open()
+        self.address = self.sock.local_address
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.join()
+        self.sock.close()
+
+    def _process(self, data, address, peer):
+        if len(data) in (29, 32, 58) and data[2:6] == 'DSVT':
+            if peer is not None:
+                for target in self.sock.peers.itervalues():
+                    if target is not peer:
+                        self.sock.write(data, target.address, target)
+            return
+        if data == DPlusKeepAlivePacket.data:
+            return
+        if data == DPlusConnectPacket.data:
+            if peer is None:
+                self.sock.add_peer(address)
+            self.sock.write(data, address)
+            return
+        if len(data) == 28 and data[:4] == '\x1c\xc0\x04\x00': # Login
+            self.sock.write(DPlusLoginOKPacket.data, address)
+            return
+        if data == DPlusDisconnectPacket.data:
+            self.sock.remove_peer(address)
+            self.sock.write(data, address)
+            return
+        self.logger.warning('unknown data received from %s', address)
+
+    def loop(self):
+        if self.sock.wait(0.1):
+            while True:
+                result = self.sock.read()
+                if result is None:
+                    break
+                self._process(*result)
+        clock = monotonic()
+        if clock - self.last_keepalive >= self.keepalive_period:
+            self.last_keepalive = clock
+            for peer in self.sock.peers.values():
+                self.sock.write(DPlusKeepAlivePacket.data, peer.address, peer)
+
+def _rooms(protocol, streams):
+    # Yields (reflector index, module) for each stream
+    for i in xrange(streams):
+        if protocol == 'dextra':
+            yield i // 26, string.ascii_uppercase[i % 26]
+        else:
+            yield i, 'A'
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def _run_reflectors(protocol, streams, pipe):
+    logging.getLogger().setLevel(logging.WARNING) # Links are logged at INFO
+    count = max(index for index, module in _rooms(protocol, streams)) + 1
+    if protocol == 'dextra':
+        reflectors = [DExtraReflector(DSTARCallsign('XRF999'), NetworkAddress('127.0.0.1', 0)) for i in xrange(count)]
+    else:
+        reflectors = [DPlusStandIn(NetworkAddress('127.0.0.1', 0)) for i in xrange(count)]
+    opened = []
+    try:
+        for reflector in reflectors:
+            reflector.__enter__()
+            opened.append(reflector)
+        pipe.send([reflector.address for reflector in reflectors])
+        if pipe.recv() == 'start': # Or stop, if the clients could not be set up
+            start_cpu = _cpu_time()
+            pipe.recv()
+            pipe.send(_cpu_time() - start_cpu)
+    finally:
+        for reflector in opened:
+            reflector.__exit__(None, None, None)
+
+def _stream(stream_id, room, frames, length):
+    # A header and length frames of voice (cycling through the given frames), for the given room
+    reflector_callsign = 'XRF999 ' + room
+    header = DSTARHeader(0, 0, 0,
+                         DSTARCallsign(reflector_callsign),
+                         DSTARCallsign(reflector_callsign[:7] + 'G'),
+                         DSTARCallsign('CQCQCQ'),
+                         DSTARCallsign('LT%05d' % stream_id),
+                         DSTARSuffix('    '))
+    stream = [DVHeaderPacket(0, 0, 0, stream_id, header)]
+    for i in xrange(length):
+        packet_id = (i % 21) | (64 if i == length - 1 else 0)
+        stream.append(DVFramePacket(0, 0, 0, stream_id, packet_id, frames[i % len(frames)]))
+    return stream
+
+class _Listener(threading.Thread):
+    def __init__(self, conn, sent_at):
+        threading.Thread.__init__(self, name='Listener-%s' % conn.callsign)
+        self.daemon = True
+        self.conn = conn
+        self.sent_at = sent_at
+        self.latency = Histogram()
+        self.received = 0
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            packet = self.conn.read(0.2)
+            if not isinstance(packet, DVFramePacket):
+                continue
+            clock = monotonic()
+            self.received += 1
+            sent_at = self.sent_at.get((packet.stream_id, packet.packet_id & 63))
+            if sent_at is not None:
+                self.latency.add(clock - sent_at)
+
+def bench_load(protocol, streams, duration=10, frames=None, loss=0, reorder=0, jitter=0, seed=0):
+    # Returns counts, CPU time and latency percentiles for streams concurrent streams
+    rng = random.Random(seed)
+    cls = DExtraConnection if protocol == 'dextra' else DPlusConnection
+    frames = frames or [SILENCE]
+    length = int(duration / FRAME_PERIOD)
+
+    parent_pipe, child_pipe = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_reflectors, args=(protocol, streams, child_pipe))
+    process.start()
+    talkers = []
+    listeners = []
+    stopped = False
+    try:
+        addresses = parent_pipe.recv()
+        sent_at = {} # (stream ID, packet ID) -> when last sent
+        rooms = list(_rooms(protocol, streams))
+        for i, (index, module) in enumerate(rooms):
+            for role, connections in (('LR', listeners), ('LT', talkers)):
+                conn = cls(DSTARCallsign('%s%05d' % (role, i)), DSTARModule('B'), DSTARCallsign('XRF999'), DSTARModule(module), addresses[index])
+                if not conn.open():
+                    raise Exception('can not link %s to %s' % (conn.callsign, addresses[index]))
+                connections.append(conn if role == 'LT' else _Listener(conn, sent_at))
+        for listener in listeners:
+            listener.start()
+        stream_list = [_stream(i + 1, module, frames, length) for i, (index, module) in enumerate(rooms)]
+
+        counts = {'sent': 0, 'dropped': 0, 'reordered': 0, 'failed': 0}
+        def send(conn, packet):
+            sent_at[(packet.stream_id, getattr(packet, 'packet_id', 0) & 63)] = monotonic()
+            if not conn.write(packet):
+                counts['failed'] += 1
+
+        # Streams start at random offsets within a frame period, as they would on a real reflector
+        phases = sorted((rng.uniform(0, FRAME_PERIOD), i) for i in xrange(streams))
+        held = [None] * streams
+        lateness = Histogram()
+        parent_pipe.send('start')
+        start_cpu = _cpu_time()
+        start_time = monotonic() + 0.1
+        for k in xrange(length + 1):
+            for phase, i in phases:
+                due = start_time + k * FRAME_PERIOD + phase
+                clock = monotonic()
+                if due > clock:
+                    time.sleep(due - clock)
+                    lateness.add(0)
+                else:
+                    lateness.add(clock - due)
+                packet = stream_list[i][k]
+                if k and rng.random() < loss:
+                    counts['dropped'] += 1
+                    continue
+                batch = [packet]
+                if held[i] is not None:
+                    batch.append(held[i])
+                    held[i] = None
+                elif k and k < length and rng.random() < reorder:
+                    held[i] = packet # Sent after the next one
+                    counts['reordered'] += 1
+                    continue
+                for packet in batch:
+                    counts['sent'] += 1
+                    if jitter:
+                        scheduler().schedule(rng.uniform(0, jitter), send, talkers[i], packet)
+                    else:
+                        send(talkers[i], packet)
+        elapsed = monotonic() - start_time
+        time.sleep(max(jitter, 0.2)) # Let packets in flight arrive
+        client_cpu = _cpu_time() - start_cpu
+        parent_pipe.send('stop')
+        stopped = True
+        reflector_cpu = parent_pipe.recv()
+
+        frames_sent = counts['sent'] - streams # Headers are not counted by listeners
+        received = sum(listener.received for listener in listeners)
+        latency = Histogram()
+        for listener in listeners:
+            latency.merge(listener.latency)
+    finally:
+        for listener in listeners:
+            listener.stopped = True
+        for listener in listeners:
+            listener.join()
+            listener.conn.close()
+        for conn in talkers:
+            conn.close()
+        if not stopped:
+            parent_pipe.send('stop')
+        process.join()
+
+    return {'protocol': protocol,
+            'streams': streams,
+            'seconds': elapsed,
+            'frames_sent': frames_sent,
+            'frames_received': received,
+            'injected_loss': counts['dropped'],
+            'reordered': counts['reordered'],
+            'send_failures': counts['failed'],
+            'loss': 1 - float(received) / frames_sent if frames_sent else 0,
+            'client_cpu': client_cpu / elapsed,
+            'client_cpu_per_stream': client_cpu / elapsed / streams,
+            'reflector_cpu': reflector_cpu / elapsed,
+            'latency': latency.snapshot(),
+            'pacing_lateness': lateness.snapshot()}
+
+def _frames_from(name):
+    with DVToolFile(name) as f:
+        return [packet.dstar_frame for packet in f.read()[1:]]
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the client stack against local stand-in reflectors.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-p', '--protocol', default='dextra', choices=['dextra', 'dplus'], help='network protocol (default: dextra)')
+    parser.add_argument('-n', '--streams', default='1,2,4,8,16,32', help='comma-separated numbers of concurrent streams to step through (default: 1,2,4,8,16,32)')
+    parser.add_argument('-d', '--duration', default=10, type=float, help='seconds to transmit at each step (default: 10)')
+    parser.add_argument('-i', '--input', default=None, help='DVTool file to take voice frames from (default: AMBE silence)')
+    parser.add_argument('-l', '--loss', default=0, type=float, help='fraction of frames to drop before sending')
+    parser.add_argument('-r', '--reorder', default=0, type=float, help='fraction of frames to send after the next one')
+    parser.add_argument('-j', '--jitter', default=0, type=float, help='maximum random delay added to each packet, in milliseconds')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='seed for loss, reordering, jitter and stream phases')
+    parser.add_argument('--max-loss', default=0.01, type=float, help='loss (beyond injected) a step can have and still count as sustained (default: 0.01)')
+    parser.add_argument('--max-latency', default=50, type=float, help='99th percentile latency, in milliseconds, a step can have and still count as sustained (default: 50)')
+    parser.add_argument('-o', '--output', default=None, help='file to also write results to (JSON)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    try:
+        steps = [int(streams) for streams in args.streams.split(',')]
+        if min(steps) < 1 or not (0 <= args.loss < 1) or not (0 <= args.reorder < 1) or args.jitter < 0:
+            raise ValueError
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+    frames = _frames_from(args.input) if args.input else None
+
+    print '%7s %9s %8s %10s %11s %8s %8s %8s %8s %9s' % ('streams', 'frames/s', 'loss %', 'cpu/strm %', 'reflector %',
+                                                         'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'late ms')
+    results = []
+    sustained = 0
+    for streams in steps:
+        result = bench_load(args.protocol, streams, args.duration, frames, args.loss, args.reorder, args.jitter / 1000.0, args.seed)
+        results.append(result)
+        latency = result['latency']
+        print '%7d %9.0f %8.2f %10.1f %11.1f %8.2f %8.2f %8.2f %8.2f %9.2f' % (
+            streams, result['frames_received'] / result['seconds'], result['loss'] * 100,
+            result['client_cpu_per_stream'] * 100, result['reflector_cpu'] * 100,
+            latency['p50'] * 1000, latency['p90'] * 1000, latency['p99'] * 1000, latency['max'] * 1000,
+            result['pacing_lateness']['p99'] * 1000)
+        sys.stdout.flush()
+        if result['loss'] <= args.max_loss and latency['p99'] * 1000 <= args.max_latency:
+            sustained = max(sustained, streams)
+    print 'sustained %d streams (at most %g%% loss, %g ms p99 latency)' % (sustained, args.max_loss * 100, args.max_latency)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'sustained_streams': sustained, 'steps': results}, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
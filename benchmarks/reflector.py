@@ -0,0 +1,101 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Relay throughput of DExtraReflector vs. number of linked peers.
+# Run from the top-level directory with: python -m benchmarks.reflector (or benchmarks.runner -s reflector)
+
+import socket
+import select
+import time
+import multiprocessing
+
+from pydv.dstar import DSTARCallsign, DSTARModule, DSTARFrame
+from pydv.dextra import DExtraConnectPacket
+from pydv.stream import DVFramePacket
+from pydv.network import NetworkAddress
+from pydv.reflector import DExtraReflector
+
+def _run_reflector(address_queue, stop_event):
+    with DExtraReflector(DSTARCallsign('XRF999'), NetworkAddress('127.0.0.1', 0), 'A') as reflector:
+        address_queue.put(reflector.address)
+        stop_event.wait()
+
+def _peer(reflector_address, index):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    callsign = DSTARCallsign('SV%dXX' % (index % 10) + chr(ord('A') + (index // 10) % 26))
+    sock.sendto(DExtraConnectPacket(callsign, DSTARModule('B'), DSTARModule('A'), 1).to_data(), reflector_address)
+    sock.settimeout(3)
+    sock.recvfrom(1024) # Ack
+    sock.setblocking(False)
+    return sock
+
+def bench_relay(peers, frames=5000, window=32):
+    # One peer talks, the rest listen. The talker keeps up to window frames in flight,
+    # as seen by the first listener, so the reflector is busy but not flooded.
+    address_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    process = multiprocessing.Process(target=_run_reflector, args=(address_queue, stop_event))
+    process.start()
+    try:
+        reflector_address = address_queue.get(timeout=5)
+        talker = _peer(reflector_address, 0)
+        listeners = [_peer(reflector_address, i + 1) for i in xrange(peers)]
+
+        data = DVFramePacket(0, 0, 0, 1, 0, DSTARFrame('\x00' * 9, '\x00' * 3)).to_data()
+        sent = 0
+        received = 0
+        start_time = time.time()
+        while received < frames:
+            while sent < frames and sent - received < window:
+                talker.sendto(data, reflector_address)
+                sent += 1
+            readable, _, _ = select.select([listeners[0]], [], [], 0.5)
+            if not readable:
+                sent = received # Lost, resend
+                continue
+            while True:
+                try:
+                    listeners[0].recvfrom(1024)
+                except socket.error:
+                    break
+                received += 1
+        elapsed = time.time() - start_time
+
+        for sock in [talker] + listeners:
+            sock.close()
+    finally:
+        stop_event.set()
+        process.join()
+    return {'peers': peers,
+            'frames': frames,
+            'seconds': elapsed,
+            'frames_per_second': frames / elapsed,
+            'packets_per_second': frames * peers / elapsed}
+
+def measurements():
+    # (name, function returning the value, unit) for the runner, with higher values being better
+    return [('reflector/relay/%d_peers' % peers, lambda peers=peers: bench_relay(peers)['packets_per_second'], 'packets/s')
+            for peers in (1, 8, 64)]
+
+def main():
+    print '%8s %12s %14s' % ('peers', 'frames/s', 'packets/s out')
+    for peers in (1, 2, 4, 8, 16, 32, 64):
+        result = bench_relay(peers)
+        print '%8d %12.0f %14.0f' % (peers, result['frames_per_second'], result['packets_per_second'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Runs benchmark suites and writes the results as JSON, optionally comparing with earlier results.
+# Run from the top-level directory with: python -m benchmarks.runner -o results.json [-c baseline.json]
+#
+# Suites define benchmarks(), returning (name, function, operations per call) for functions to time
+# (None if not available), and/or measurements(), returning (name, function, unit) for functions that
+# measure themselves and return the value. Higher values are better.
+
+import os
+import sys
+import argparse
+import importlib
+import json
+import platform
+import subprocess
+import time
+import gc
+import logging
+
+SUITES = ['codecs', 'vocoder', 'reflector']
+
+def _commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _time(function, number):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start_time = time.time()
+        for i in xrange(number):
+            function()
+        return time.time() - start_time
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def time_function(function, operations=1, min_time=0.2, repeat=5):
+    # Calls function enough times for each run to take about min_time, and keeps the best run
+    number = 1
+    while True:
+        elapsed = _time(function, number)
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / elapsed))
+    best = min(_time(function, number) for i in xrange(repeat))
+    return {'value': number * operations / best,
+            'unit': 'ops/s',
+            'ns_per_op': best * 1e9 / (number * operations),
+            'calls': number,
+            'repeat': repeat}
+
+def run(suites, match=None, min_time=0.2, repeat=5):
+    results = {}
+    for suite in suites:
+        module = importlib.import_module('benchmarks.%s' % suite)
+        if hasattr(module, 'benchmarks'):
+            for name, function, operations in module.benchmarks():
+                if match and match not in name:
+                    continue
+                if function is None:
+                    results[name] = {'skipped': 'not available'}
+                else:
+                    results[name] = time_function(function, operations, min_time, repeat)
+                _print_result(name, results[name])
+        if hasattr(module, 'measurements'):
+            for name, function, unit in module.measurements():
+                if match and match not in name:
+                    continue
+                results[name] = {'value': function(), 'unit': unit}
+                _print_result(name, results[name])
+    return results
+
+def _print_result(name, result):
+    if 'skipped' in result:
+        print >> sys.stderr, '%-50s %16s' % (name, 'skipped')
+    elif 'ns_per_op' in result:
+        print >> sys.stderr, '%-50s %12.0f %-10s %10.0f ns' % (name, result['value'], result['unit'], result['ns_per_op'])
+    else:
+        print >> sys.stderr, '%-50s %12.0f %-10s' % (name, result['value'], result['unit'])
+
+def compare(results, baseline, threshold):
+    # Prints the change of each benchmark and returns the names of those that got slower than threshold percent,
+    # and of those in the baseline that are now missing or skipped
+    regressions = []
+    print >> sys.stderr, '\n%-50s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'change')
+    for name in sorted(results):
+        current = results[name].get('value')
+        previous = baseline.get(name, {}).get('value')
+        if not current or not previous:
+            continue
+        change = (current - previous) * 100.0 / previous
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' <-- slower'
+        print >> sys.stderr, '%-50s %12.0f %12.0f %+7.1f%%%s' % (name, previous, current, change, flag)
+
+    missing = sorted([name for name in baseline if baseline[name].get('value') and not results.get(name, {}).get('value')])
+    if missing:
+        print >> sys.stderr, '\nin the baseline, but not measured now:'
+        for name in missing:
+            print >> sys.stderr, '%-50s %12s' % (name, 'skipped' if name in results else 'missing')
+    return regressions, missing
+
+def main():
+    parser = argparse.ArgumentParser(description='pydv benchmark runner. Writes results as JSON, with higher values being better.')
+    parser.add_argument('-s', '--suite', action='append', choices=SUITES, help='suite to run (default: all, may be given more than once)')
+    parser.add_argument('-k', '--match', default=None, help='run only benchmarks with names containing this')
+    parser.add_argument('-t', '--min-time', default=0.2, type=float, help='seconds each timed run should take (default: 0.2)')
+    parser.add_argument('-r', '--repeat', default=5, type=int, help='timed runs per benchmark, the best is kept (default: 5)')
+    parser.add_argument('-o', '--output', default='-', help='file to write results to (default: - for stdout)')
+    parser.add_argument('-c', '--compare', default=None, metavar='BASELINE', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', default=10, type=float, help='slowdown, in percent, that counts as a regression (default: 10)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING) # DVToolFile logs every stream written
+
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+        except (IOError, ValueError, KeyError) as e:
+            print >> sys.stderr, 'can not read %s: %s' % (args.compare, str(e))
+            sys.exit(1)
+
+    report = {'commit': _commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': run(args.suite or SUITES, args.match, args.min_time, args.repeat)}
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print data
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+
+    if baseline is not None:
+        regressions, missing = compare(report['results'], baseline, args.threshold)
+        failed = False
+        if regressions:
+            print >> sys.stderr, '%d benchmarks are more than %g%% slower' % (len(regressions), args.threshold)
+            failed = True
+        if missing and not (args.suite or args.match): # Otherwise, some are expected to be missing
+            print >> sys.stderr, '%d benchmarks are missing or skipped' % len(missing)
+            failed = True
+        if failed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Vocoder bindings: AMBE decoding with mbelib, Codec 2 encoding and decoding, and Golay FEC.
+# Benchmarks of bindings that are not built are skipped.
+# Run from the top-level directory with: python -m benchmarks.runner -s vocoder
+
+import math
+import struct
+
+from pydv.vocoder import Vocoder, DVEncoder, DVDecoder
+
+AMBE_FRAME = '\x9e\x8d\x32\x88\x26\x1a\x3f\x61\xe8'
+
+def _tone(frequency=440):
+    # 160 samples (20 ms) of a sine wave
+    return struct.pack('<160h', *[int(8000 * math.sin(2 * math.pi * frequency * i / 8000.0)) for i in xrange(160)])
+
+def benchmarks():
+    # (name, function, operations per call)
+    result = []
+
+    try:
+        import pydv.mbelib
+    except ImportError:
+        result.append(('mbelib/decode_dstar', None, 1))
+    else:
+        state = pydv.mbelib.init_state()
+        result.append(('mbelib/decode_dstar', lambda: pydv.mbelib.decode_dstar(state, AMBE_FRAME), 1))
+        decoder = DVDecoder(Vocoder.AMBE)
+        result.append(('vocoder/ambe/decode', lambda: decoder.decode(AMBE_FRAME), 1))
+
+    try:
+        import pydv.codec2
+    except ImportError:
+        for name in ('codec2/3200/encode', 'codec2/3200/decode', 'codec2/2400/encode', 'codec2/2400/decode',
+                     'golay23/encode', 'golay23/decode'):
+            result.append((name, None, 1))
+        return result
+
+    samples = _tone()
+    for vocoder, mode, name in ((Vocoder.CODEC2_3200, pydv.codec2.CODEC2_MODE_3200, '3200'),
+                                (Vocoder.CODEC2_2400, pydv.codec2.CODEC2_MODE_2400, '2400')):
+        state = pydv.codec2.codec2_create(mode)
+        bits = pydv.codec2.codec2_encode(state, samples)
+        result.append(('codec2/%s/encode' % name, lambda state=state: pydv.codec2.codec2_encode(state, samples), 1))
+        result.append(('codec2/%s/decode' % name, lambda state=state, bits=bits: pydv.codec2.codec2_decode(state, bits), 1))
+        # Including FEC and packing into the 9 bytes of a frame
+        encoder = DVEncoder(vocoder)
+        dvcodec = encoder.encode(samples)
+        decoder = DVDecoder(vocoder)
+        result.append(('vocoder/codec2_%s/encode' % name, lambda encoder=encoder: encoder.encode(samples), 1))
+        result.append(('vocoder/codec2_%s/decode' % name, lambda decoder=decoder, dvcodec=dvcodec: decoder.decode(dvcodec), 1))
+
+    pydv.codec2.golay23_init()
+    codeword = pydv.codec2.golay23_encode(0xabc)
+    result.append(('golay23/encode', lambda: pydv.codec2.golay23_encode(0xabc), 1))
+    result.append(('golay23/decode', lambda: pydv.codec2.golay23_decode(codeword ^ 0x10001), 1)) # With two bit errors
+    return result
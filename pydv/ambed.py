@@ -16,10 +16,15 @@
 
 import logging
 import struct
+import time
+import threading
+
+from collections import OrderedDict
 
 from dstar import DSTARCallsign
 from stream import Packet, FixedPacket, StreamReceiveThread, StreamConnection
 from network import NetworkAddress
+from metrics import Histogram
 from utils import or_valueerror
 
 # No Enum available in Python 2.7
@@ -163,9 +168,11 @@ class AMBEdStreamRecieveThread(StreamReceiveThread):
         except ValueError:
             pass
         else:
-            self.logger.debug('received frame out packet')
+            if self.debug:
+                self.logger.debug('received frame out packet')
             return packet
 
+        self.unknown_count += 1
         self.logger.warning('unknown data received')
 
 class AMBEdStream(StreamConnection):
@@ -179,6 +186,7 @@ class AMBEdStream(StreamConnection):
         self.codec_in = codec_in
         self.codecs_out = codecs_out
         self.receive_thread = AMBEdStreamRecieveThread(self.sock)
+        self.reused = False # Handed out again by a stream pool
 
     def _disconnect(self, timeout=3):
         self.connection.write(AMBEdCloseStreamPacket(self.stream_id))
@@ -187,6 +195,43 @@ class AMBEdStream(StreamConnection):
     def read(self, timeout=3):
         return self._read(timeout, [AMBEdFrameOutPacket])
 
+    def flush(self):
+        # Drop any late replies left over from a previous job
+        while not self.receive_thread.queue.empty():
+            self.receive_thread.queue.get()
+
+    def transcode(self, frames, window=32, timeout=1):
+        # Keep up to window frames in flight and match replies to frames by packet_id,
+        # instead of pacing frames at real time and expecting replies in order.
+        # Returns a list of AMBEdFrameOutPacket, with None for frames that got no reply.
+        or_valueerror(0 < window <= 128) # Leave room for late replies in the 8-bit packet_id space
+        results = [None] * len(frames)
+        pending = OrderedDict() # packet_id -> (index, deadline)
+        next_index = 0
+        while next_index < len(frames) or pending:
+            while next_index < len(frames) and len(pending) < window:
+                packet_id = next_index % 256
+                self.write(AMBEdFrameInPacket(packet_id, self.codec_in, frames[next_index]))
+                pending[packet_id] = (next_index, time.time() + timeout)
+                next_index += 1
+
+            # Wait for a reply, but not after the oldest frame in flight expires
+            _, deadline = next(pending.itervalues())
+            packet = self._read(max(deadline - time.time(), 0.01), [AMBEdFrameOutPacket])
+            if packet:
+                if packet.packet_id in pending:
+                    index, _ = pending.pop(packet.packet_id)
+                    results[index] = packet
+                continue
+
+            clock = time.time()
+            for packet_id, (index, deadline) in pending.items():
+                if deadline > clock:
+                    break
+                del pending[packet_id]
+                self.logger.debug('no reply for frame %s', index)
+        return results
+
 class AMBEdConnectionRecieveThread(StreamReceiveThread):
     def __init__(self, sock, callsign):
         StreamReceiveThread.__init__(self, sock)
@@ -217,6 +262,7 @@ class AMBEdConnectionRecieveThread(StreamReceiveThread):
             self.logger.debug('received keepalive packet')
             return packet
 
+        self.unknown_count += 1
         self.logger.warning('unknown data received')
 
 class AMBEdConnection(StreamConnection):
@@ -230,6 +276,11 @@ class AMBEdConnection(StreamConnection):
         self.callsign = callsign
         self.receive_thread = AMBEdConnectionRecieveThread(self.sock, self.callsign)
 
+        self.busy_count = 0
+        self.timeout_count = 0
+        self.ping_rtt = Histogram()
+        self.request_lock = threading.Lock() # Replies are not matched to requests, so one request at a time
+
         self.codecs_out_map = {AMBEdCodec.AMBEPLUS: AMBEdCodec.AMBE2PLUS | AMBEdCodec.CODEC2_3200,
                                AMBEdCodec.AMBE2PLUS: AMBEdCodec.AMBEPLUS | AMBEdCodec.CODEC2_3200,
                                AMBEdCodec.CODEC2_3200: AMBEdCodec.AMBEPLUS | AMBEdCodec.AMBE2PLUS,
@@ -246,12 +297,264 @@ class AMBEdConnection(StreamConnection):
 
     def get_stream(self, codec_in, timeout=3):
         codecs_out = self.codecs_out_map[codec_in]
-        self.write(AMBEdOpenStreamPacket(self.callsign, codec_in, codecs_out))
-        packet = self._read(timeout, [AMBEdStreamDescriptorPacket, AMBEdBusyPacket])
+        with self.request_lock:
+            self.write(AMBEdOpenStreamPacket(self.callsign, codec_in, codecs_out))
+            packet = self._read(timeout, [AMBEdStreamDescriptorPacket, AMBEdBusyPacket])
         if packet and isinstance(packet, AMBEdStreamDescriptorPacket):
             return AMBEdStream(self,
                                packet.stream_id,
                                codec_in,
                                codecs_out,
                                NetworkAddress(self.address.host, packet.port))
+        if packet:
+            self.busy_count += 1
+        else:
+            self.timeout_count += 1
         return None
+
+    def ping(self, timeout=3):
+        # Returns the round trip time, or None if there was no reply
+        with self.request_lock:
+            clock = time.time()
+            self.write(AMBEdPingPacket(self.callsign))
+            if not self._read(timeout, [AMBEdPongPacket]):
+                return None
+            rtt = time.time() - clock
+        self.ping_rtt.add(rtt)
+        return rtt
+
+    def stats(self):
+        stats = StreamConnection.stats(self)
+        stats.update({'busy': self.busy_count,
+                      'timeouts': self.timeout_count,
+                      'ping_rtt': self.ping_rtt.snapshot()})
+        return stats
+
+class AMBEdStreamPool(object):
+    # Keep transcoding streams open between jobs, to avoid a handshake per job.
+    # AMBEd drops streams after 3 seconds without activity, so these are not reused after max_idle seconds.
+    # The server is pinged at least every check_interval seconds before reusing, so that no idle stream
+    # outlives a server restart unnoticed.
+    def __init__(self, connection, max_idle=2, check_interval=1, retries=3):
+        or_valueerror(check_interval <= max_idle)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.connection = connection
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.retries = retries
+
+        self.lock = threading.Lock()
+        self.idle_streams = {} # codec_in -> [(stream, release time)]
+        self.last_check = 0
+        self.rtt = None
+
+        self.hits = 0
+        self.misses = 0
+        self.handshake_count = 0
+        self.handshake_time = 0
+
+    def _check(self):
+        # The lock only protects the pool's state, so other threads can use the server while pinging
+        with self.lock:
+            clock = time.time()
+            if clock - self.last_check < self.check_interval:
+                return True
+            self.last_check = clock # Ping from one thread at a time
+        rtt = self.connection.ping()
+        if rtt is None:
+            self.logger.warning('no reply to ping, closing idle streams')
+            with self.lock:
+                self.last_check = 0
+            self._close_idle()
+            return False
+        self.rtt = rtt
+        return True
+
+    def _close_idle(self):
+        with self.lock:
+            idle_streams = self.idle_streams
+            self.idle_streams = {}
+        for streams in idle_streams.values():
+            for stream, _ in streams:
+                stream.close()
+
+    def acquire(self, codec_in, timeout=3, reuse=True):
+        # Without reuse, a new stream is always opened
+        if reuse and self._check():
+            stream = None
+            expired = []
+            with self.lock:
+                streams = self.idle_streams.get(codec_in, [])
+                while streams:
+                    candidate, release_time = streams.pop()
+                    if time.time() - release_time < self.max_idle:
+                        stream = candidate
+                        self.hits += 1
+                        break
+                    expired.append(candidate)
+            for candidate in expired:
+                candidate.close()
+            if stream is not None:
+                stream.reused = True
+                return stream
+        with self.lock:
+            self.misses += 1
+
+        # Open a new stream, retrying if the server is busy or does not reply
+        for i in xrange(self.retries):
+            clock = time.time()
+            stream = self.connection.get_stream(codec_in, timeout)
+            if stream is None:
+                self.logger.warning('can not open stream (attempt %d of %d)', i + 1, self.retries)
+                continue
+            with self.lock:
+                self.handshake_count += 1
+                self.handshake_time += time.time() - clock
+            if not stream.open():
+                self.connection.write(AMBEdCloseStreamPacket(stream.stream_id))
+                continue
+            return stream
+        return None
+
+    def release(self, stream, healthy=True):
+        # Streams that failed (i.e., timed out) are closed instead of being reused
+        if not healthy:
+            stream.close()
+            return
+        stream.flush()
+        with self.lock:
+            self.idle_streams.setdefault(stream.codec_in, []).append((stream, time.time()))
+
+    def close(self):
+        self._close_idle()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    @property
+    def handshake_time_saved(self):
+        if not self.handshake_count:
+            return 0.0
+        return self.hits * (self.handshake_time / self.handshake_count)
+
+class AMBEdServer(object):
+    # Scheduling state and statistics for one AMBEd server
+    def __init__(self, connection, capacity):
+        self.connection = connection
+        self.pool = AMBEdStreamPool(connection)
+        self.capacity = capacity
+
+        self.active = 0
+        self.failures = 0
+        self.down_until = 0
+
+        self.jobs = 0
+        self.frames = 0
+        self.busy_time = 0
+
+    def __str__(self):
+        return str(self.connection.address)
+
+    @property
+    def busy_rate(self):
+        attempts = self.pool.handshake_count + self.connection.busy_count + self.connection.timeout_count
+        return float(self.connection.busy_count) / attempts if attempts else 0.0
+
+    @property
+    def throughput(self):
+        # Frames per second while transcoding
+        return self.frames / self.busy_time if self.busy_time else 0.0
+
+class AMBEdScheduler(object):
+    # Spread transcoding streams over several AMBEd servers, by free capacity.
+    # Servers that are busy or do not reply are skipped for a while, with backoff.
+    def __init__(self, servers, backoff=1, max_backoff=60):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.servers = servers
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def open(self):
+        for server in self.servers:
+            if not server.connection.open():
+                raise Exception('can not open connection to %s' % (server,))
+
+    def close(self):
+        for server in self.servers:
+            server.pool.close()
+            server.connection.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def capacity(self):
+        return sum([server.capacity for server in self.servers])
+
+    def _choose(self, exclude):
+        clock = time.time()
+        candidates = [server for server in self.servers if server not in exclude and server.down_until <= clock]
+        if not candidates:
+            return None
+        # Most free capacity first, then fewer busy replies, then lower latency
+        return max(candidates, key=lambda server: (server.capacity - server.active,
+                                                   -server.busy_rate,
+                                                   -(server.pool.rtt if server.pool.rtt is not None else 0)))
+
+    def _fail(self, server):
+        server.failures += 1
+        delay = min(self.backoff * (2 ** min(server.failures - 1, 16)), self.max_backoff)
+        server.down_until = time.time() + delay
+        self.logger.warning('server %s failed, skipping it for %.1f seconds', server, delay)
+
+    def acquire(self, codec_in, exclude=(), reuse=True, wait=False):
+        # Returns (server, stream), or (None, None) if no server could open a stream.
+        # With wait, servers that are being skipped after failing are waited for.
+        exclude = list(exclude)
+        while True:
+            with self.lock:
+                server = self._choose(exclude)
+                if server is None:
+                    waiting = [candidate.down_until for candidate in self.servers if candidate not in exclude]
+                    if not wait or not waiting:
+                        return None, None
+                    delay = min(waiting) - time.time()
+                else:
+                    server.active += 1
+            if server is None:
+                time.sleep(max(delay, 0.01))
+                continue
+            stream = server.pool.acquire(codec_in, reuse=reuse)
+            if stream is not None:
+                return server, stream
+            with self.lock:
+                server.active -= 1
+                self._fail(server)
+            exclude.append(server)
+
+    def release(self, server, stream, healthy=True, frames=0, elapsed=0):
+        server.pool.release(stream, healthy)
+        with self.lock:
+            server.active -= 1
+            if healthy:
+                server.failures = 0
+                server.jobs += 1
+                server.frames += frames
+                server.busy_time += elapsed
+            elif not stream.reused: # A reused stream may have been dropped by the server for inactivity
+                self._fail(server)
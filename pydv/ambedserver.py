@@ -0,0 +1,268 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import sys
+import argparse
+import logging
+import socket
+import select
+import random
+import heapq
+import time
+
+from ambed import AMBEdCodec, AMBEdOpenStreamPacket, AMBEdStreamDescriptorPacket, AMBEdBusyPacket, AMBEdCloseStreamPacket, AMBEdPingPacket, AMBEdPongPacket, AMBEdFrameInPacket, AMBEdFrameOutPacket, AMBEdConnection
+from network import NetworkAddress
+from utils import StoppableThread
+from vocoder import Vocoder, AMBE_SILENCE, DVDecoder, DVEncoder
+
+_VOCODERS = {AMBEdCodec.AMBEPLUS: Vocoder.AMBE,
+             AMBEdCodec.CODEC2_3200: Vocoder.CODEC2_3200,
+             AMBEdCodec.CODEC2_2400: Vocoder.CODEC2_2400}
+
+class AMBEdEmulatorStream(object):
+    def __init__(self, stream_id, sock, codec_in, codecs_out, transcode):
+        self.stream_id = stream_id
+        self.sock = sock
+        self.codec_in = codec_in
+        self.codecs_out = [codec for codec in (AMBEdCodec.AMBEPLUS, AMBEdCodec.AMBE2PLUS, AMBEdCodec.CODEC2_3200, AMBEdCodec.CODEC2_2400)
+                           if codecs_out & codec][:2]
+        self.last_activity = time.time()
+
+        # Only Codec 2 can be encoded locally, everything else is synthetic
+        self.decoder = None
+        self.encoders = {}
+        if transcode and codec_in in _VOCODERS:
+            self.decoder = DVDecoder(_VOCODERS[codec_in])
+            for codec in self.codecs_out:
+                if codec in (AMBEdCodec.CODEC2_3200, AMBEdCodec.CODEC2_2400):
+                    self.encoders[codec] = DVEncoder(_VOCODERS[codec])
+
+    def _synthetic(self, codec):
+        if codec in (AMBEdCodec.AMBEPLUS, AMBEdCodec.AMBE2PLUS):
+            return AMBE_SILENCE
+        return '\x00' * 9
+
+    def transcode(self, frame_in):
+        data = None
+        if self.decoder:
+            data = self.decoder.decode(frame_in.data)
+        frames = []
+        for codec in self.codecs_out:
+            encoder = self.encoders.get(codec)
+            frames.append(encoder.encode(data).ljust(9, '\x00') if encoder else self._synthetic(codec))
+        while len(frames) < 2:
+            frames.append('\x00' * 9)
+        codec1 = self.codecs_out[0] if len(self.codecs_out) > 0 else AMBEdCodec.NONE
+        codec2 = self.codecs_out[1] if len(self.codecs_out) > 1 else AMBEdCodec.NONE
+        return AMBEdFrameOutPacket(frame_in.packet_id, codec1, codec2, frames[0], frames[1])
+
+class AMBEdEmulator(StoppableThread):
+    # Speaks the AMBEd protocol, to test and benchmark clients without hardware.
+    # Frames are either transcoded with the local vocoders, or replaced with silence,
+    # and replies can be delayed, jittered and dropped.
+    def __init__(self, address=None, max_streams=4, delay=0, jitter=0, loss=0, transcode=False, stream_timeout=3, seed=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        StoppableThread.__init__(self, name=self.__class__.__name__)
+        self._sleep_period = 0
+        self.daemon = True
+
+        if address is None:
+            address = NetworkAddress('0.0.0.0', AMBEdConnection.DEFAULT_PORT)
+        self.address = address
+        self.max_streams = max_streams
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.transcode = transcode
+        self.stream_timeout = stream_timeout
+        self.random = random.Random(seed)
+
+        self.sock = None
+        self.streams = {} # socket -> stream
+        self.next_stream_id = 1
+        self.replies = [] # Heap of (time, sequence, socket, address, data)
+        self.reply_sequence = 0
+
+        self.frame_count = 0
+        self.dropped_count = 0
+        self.busy_count = 0
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.address = NetworkAddress(*self.sock.getsockname())
+        self.logger.info('listening at %s', self.address)
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.sock.close()
+        self.streams = {}
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        self.open()
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.join()
+        self.close()
+
+    def _reply(self, sock, address, data, delayed=False):
+        if not delayed:
+            sock.sendto(data, address)
+            return
+        due = time.time() + self.delay + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        heapq.heappush(self.replies, (due, self.reply_sequence, sock, address, data))
+        self.reply_sequence += 1
+
+    def _open_stream(self, packet, address):
+        if len(self.streams) >= self.max_streams:
+            self.busy_count += 1
+            self._reply(self.sock, address, AMBEdBusyPacket().to_data())
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.address.host, 0))
+        stream = AMBEdEmulatorStream(self.next_stream_id, sock, packet.codec_in, packet.codecs_out, self.transcode)
+        self.next_stream_id = (self.next_stream_id % 0xffff) + 1
+        self.streams[sock] = stream
+        port = sock.getsockname()[1]
+        self.logger.debug('opened stream %s at port %s for %s', stream.stream_id, port, packet.callsign)
+        self._reply(self.sock, address, AMBEdStreamDescriptorPacket(stream.stream_id, port, packet.codec_in, packet.codecs_out).to_data())
+
+    def _close_stream(self, stream):
+        self.logger.debug('closed stream %s', stream.stream_id)
+        del self.streams[stream.sock]
+        stream.sock.close()
+
+    def _process_control(self):
+        data, address = self.sock.recvfrom(1024)
+        try:
+            packet = AMBEdOpenStreamPacket.from_data(data)
+        except ValueError:
+            pass
+        else:
+            self._open_stream(packet, address)
+            return
+
+        try:
+            packet = AMBEdCloseStreamPacket.from_data(data)
+        except ValueError:
+            pass
+        else:
+            for stream in self.streams.values():
+                if stream.stream_id == packet.stream_id:
+                    self._close_stream(stream)
+            return
+
+        try:
+            packet = AMBEdPingPacket.from_data(data)
+        except ValueError:
+            pass
+        else:
+            self._reply(self.sock, address, AMBEdPongPacket().to_data())
+            return
+
+        self.logger.warning('unknown data received')
+
+    def _process_stream(self, stream):
+        data, address = stream.sock.recvfrom(1024)
+        try:
+            packet = AMBEdFrameInPacket.from_data(data)
+        except ValueError:
+            self.logger.warning('unknown data received')
+            return
+
+        stream.last_activity = time.time()
+        self.frame_count += 1
+        if self.loss and self.random.random() < self.loss:
+            self.dropped_count += 1
+            return
+        self._reply(stream.sock, address, stream.transcode(packet).to_data(), True)
+
+    def loop(self):
+        clock = time.time()
+        while self.replies and self.replies[0][0] <= clock:
+            _, _, sock, address, data = heapq.heappop(self.replies)
+            if sock in self.streams or sock is self.sock: # Stream may have been closed meanwhile
+                sock.sendto(data, address)
+
+        for stream in self.streams.values():
+            if clock - stream.last_activity > self.stream_timeout:
+                self._close_stream(stream)
+
+        timeout = 0.1
+        if self.replies:
+            timeout = min(max(self.replies[0][0] - clock, 0), timeout)
+        readable, _, _ = select.select([self.sock] + self.streams.keys(), [], [], timeout)
+        for sock in readable:
+            if sock is self.sock:
+                self._process_control()
+            elif sock in self.streams:
+                self._process_stream(self.streams[sock])
+
+def dv_ambed():
+    parser = argparse.ArgumentParser(description='AMBEd emulator. Answers AMBEd clients without transcoding hardware, for testing.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-a', '--address', default='0.0.0.0', help='address to listen at')
+    parser.add_argument('-p', '--port', default=AMBEdConnection.DEFAULT_PORT, type=int, help='port to listen at')
+    parser.add_argument('-s', '--streams', default=4, type=int, help='maximum number of concurrent streams')
+    parser.add_argument('-d', '--delay', default=0.0, type=float, help='delay before replying to each frame (ms)')
+    parser.add_argument('-j', '--jitter', default=0.0, type=float, help='random extra delay for each frame, up to this amount (ms)')
+    parser.add_argument('-l', '--loss', default=0.0, type=float, help='probability of dropping each frame (0-1)')
+    parser.add_argument('-t', '--transcode', default=False, action='store_true', help='transcode with the local vocoders, instead of replying with silence')
+    parser.add_argument('--seed', default=None, type=int, help='random seed for jitter and loss')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    if args.streams < 1 or args.delay < 0 or args.jitter < 0 or not (0 <= args.loss <= 1):
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        with AMBEdEmulator(NetworkAddress(args.address, args.port),
+                           max_streams=args.streams,
+                           delay=args.delay / 1000.0,
+                           jitter=args.jitter / 1000.0,
+                           loss=args.loss,
+                           transcode=args.transcode,
+                           seed=args.seed) as emulator:
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            logger.info('received %d frames (%d dropped), %d busy replies',
+                        emulator.frame_count, emulator.dropped_count, emulator.busy_count)
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+def main():
+    dv_ambed()
+
+if __name__ == '__main__':
+    dv_ambed()
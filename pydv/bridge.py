@@ -0,0 +1,247 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import sys
+import argparse
+import logging
+import random
+import struct
+import time
+
+from crc import CCITTChecksum
+from dstar import DSTARCallsign, DSTARModule
+from dextra import DExtraConnectionRecieveThread
+from dplus import DPlusConnectionRecieveThread, DPlusConnection
+from stream import DisconnectedError
+from connect import connection_classes, connect
+from metrics import Histogram
+from exporter import MetricsExporter
+from tracing import add_trace_arguments, setup_tracing
+
+# DPlus appends this to the last frame (see DPlusFramePacket)
+_DPLUS_LAST_FRAME_TRAILER = '\x55\xc8\x7a\x55\x55\x55\x55\x55\x55\x55\x55\x55\x25\x1a\xc6'
+
+def is_dsvt(data):
+    # DExtra (and DPlus without its prefix) voice packets: header or frame
+    return (len(data) == 56 or len(data) == 27) and data[:4] == 'DSVT'
+
+def dplus_to_dsvt(data):
+    # Returns the voice packet without the DPlus prefix, or None if this is not a voice packet
+    length = len(data)
+    if length == 29 and data[:2] == '\x1d\x80':
+        return data[2:]
+    if length == 58 and data[:2] == '\x3a\x80':
+        return data[2:]
+    if length == 32 and data[:2] == '\x20\x80':
+        # Last frame: undo the marker byte and set the last frame bit
+        return data[2:8] + '\x00' + data[9:16] + chr(ord(data[16]) | 64) + data[17:29]
+    return None
+
+def dsvt_to_dplus(data):
+    if len(data) == 56:
+        return '\x3a\x80' + data
+    if ord(data[14]) & 64 == 0:
+        return '\x1d\x80' + data
+    return '\x20\x80' + data[:6] + '\x81' + data[7:15] + _DPLUS_LAST_FRAME_TRAILER
+
+def rewrite_stream(data, stream_id, repeater_1=None, repeater_2=None):
+    # Replace the stream ID and, in headers, the repeater callsigns (recomputing the checksum)
+    data = data[:12] + struct.pack('<H', stream_id) + data[14:]
+    if len(data) == 56 and repeater_1 is not None:
+        header = data[15:18] + repeater_1 + repeater_2 + data[34:54]
+        checksum = CCITTChecksum()
+        checksum.update(header)
+        data = data[:15] + header + checksum.result()
+    return data
+
+class _BridgeDExtraReceiveThread(DExtraConnectionRecieveThread):
+    def __init__(self, sock, callsign, relay):
+        DExtraConnectionRecieveThread.__init__(self, sock, callsign)
+        self.relay = relay
+
+    def _process(self, data):
+        if is_dsvt(data):
+            self.relay(data)
+            return
+        return DExtraConnectionRecieveThread._process(self, data)
+
+class _BridgeDPlusReceiveThread(DPlusConnectionRecieveThread):
+    def __init__(self, sock, relay):
+        DPlusConnectionRecieveThread.__init__(self, sock)
+        self.relay = relay
+
+    def _process(self, data):
+        dsvt = dplus_to_dsvt(data)
+        if dsvt is not None:
+            self.relay(dsvt)
+            return
+        return DPlusConnectionRecieveThread._process(self, data)
+
+class BridgeDirection(object):
+    # Relays voice packets from one connection to the other, keeping them as bytes.
+    # Streams that never ended are forgotten after stream_timeout seconds without packets,
+    # once there are more than max_streams.
+    def __init__(self, stream_timeout=10, max_streams=256):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.source = None
+        self.target = None
+        self.stream_timeout = stream_timeout
+        self.max_streams = max_streams
+        self.streams = {} # Source stream ID -> [last activity, target stream ID]
+        self.packet_count = 0
+        self.latency = Histogram()
+
+    def attach(self, source, target):
+        self.source = source
+        self.target = target
+        self.to_dplus = isinstance(target, DPlusConnection)
+        self.repeater_1 = str(target.reflector_callsign)[:7] + str(target.reflector_module)
+        self.repeater_2 = str(target.reflector_callsign)[:7] + 'G'
+
+    def relay(self, data):
+        if self.target is None: # Still connecting
+            return
+        clock = time.time()
+
+        stream_id, = struct.unpack('<H', data[12:14])
+        entry = self.streams.get(stream_id)
+        if entry is not None:
+            entry[0] = clock
+            target_stream_id = entry[1]
+        else:
+            if len(self.streams) >= self.max_streams:
+                self._expire(clock)
+            target_stream_id = random.getrandbits(16)
+            self.streams[stream_id] = [clock, target_stream_id]
+            self.logger.info('relaying stream %s from %s as %s to %s', stream_id, self.source.reflector_callsign, target_stream_id, self.target.reflector_callsign)
+        data = rewrite_stream(data, target_stream_id, self.repeater_1, self.repeater_2)
+        if len(data) == 27 and ord(data[14]) & 64:
+            del self.streams[stream_id]
+        self.target.sock.write(dsvt_to_dplus(data) if self.to_dplus else data)
+
+        self.packet_count += 1
+        self.latency.add(time.time() - clock)
+
+    def _expire(self, clock):
+        for stream_id, (last_activity, _) in self.streams.items():
+            if clock - last_activity > self.stream_timeout:
+                del self.streams[stream_id]
+        if len(self.streams) >= self.max_streams: # All active, so forget the one idle the longest
+            del self.streams[min(self.streams, key=lambda stream_id: self.streams[stream_id][0])]
+
+def tap(connection, relay):
+    # Have voice packets received by the connection passed to relay as bytes, instead of being queued
+    if isinstance(connection, DPlusConnection):
+        connection.receive_thread = _BridgeDPlusReceiveThread(connection.sock, relay)
+    else:
+        connection.receive_thread = _BridgeDExtraReceiveThread(connection.sock, connection.callsign, relay)
+
+class ReflectorBridge(object):
+    # Reflectors are given as (reflector_callsign, reflector_module, host, connection_classes)
+    def __init__(self, callsign, reflector_a, reflector_b):
+        self.callsign = callsign
+        self.reflector_a = reflector_a
+        self.reflector_b = reflector_b
+        self.connection_a = None
+        self.connection_b = None
+        self.a_to_b = BridgeDirection()
+        self.b_to_a = BridgeDirection()
+
+    def __enter__(self):
+        self.connection_a = connect(self.callsign, DSTARModule(' '), *self.reflector_a,
+                                    setup=lambda conn: tap(conn, self.a_to_b.relay))
+        try:
+            self.connection_b = connect(self.callsign, DSTARModule(' '), *self.reflector_b,
+                                        setup=lambda conn: tap(conn, self.b_to_a.relay))
+        except:
+            self.connection_a.close()
+            raise
+        self.a_to_b.attach(self.connection_a, self.connection_b)
+        self.b_to_a.attach(self.connection_b, self.connection_a)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.connection_b.close()
+        self.connection_a.close()
+
+    def read(self, timeout=3):
+        # Voice is relayed by the receive threads, so this only waits for disconnection
+        self.connection_a._read(timeout / 2.0, [])
+        self.connection_b._read(timeout / 2.0, [])
+
+def dv_bridge():
+    parser = argparse.ArgumentParser(description='D-STAR bridge. Connects to two reflectors and relays traffic between them.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('--protocol-a', default='auto', help='network protocol for the first reflector (dextra, dextraopen, dplus, or auto to try all in parallel)')
+    parser.add_argument('--protocol-b', default='auto', help='network protocol for the second reflector (dextra, dextraopen, dplus, or auto to try all in parallel)')
+    parser.add_argument('--metrics-port', default=None, type=int, help='serve metrics in the Prometheus text format at this port on localhost')
+    parser.add_argument('callsign', help='your callsign')
+    parser.add_argument('reflector_a', help='first reflector\'s callsign')
+    parser.add_argument('module_a', help='first reflector\'s module')
+    parser.add_argument('address_a', help='first reflector\'s hostname or IP address')
+    parser.add_argument('reflector_b', help='second reflector\'s callsign')
+    parser.add_argument('module_b', help='second reflector\'s module')
+    parser.add_argument('address_b', help='second reflector\'s hostname or IP address')
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    setup_tracing(args)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    try:
+        callsign = DSTARCallsign(args.callsign)
+        reflectors = [(DSTARCallsign(reflector), DSTARModule(module), address, connection_classes(protocol))
+                      for protocol, reflector, module, address in ((args.protocol_a, args.reflector_a, args.module_a, args.address_a),
+                                                                   (args.protocol_b, args.reflector_b, args.module_b, args.address_b))]
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        with MetricsExporter(args.metrics_port) as exporter, ReflectorBridge(callsign, *reflectors) as bridge:
+            def collect(metrics):
+                for direction in (bridge.a_to_b, bridge.b_to_a):
+                    labels = {'source': str(direction.source.reflector_callsign).strip(),
+                              'target': str(direction.target.reflector_callsign).strip()}
+                    metrics.add('pydv_bridge_packets_total', 'counter', 'Packets relayed', direction.packet_count, labels)
+                    metrics.add_histogram('pydv_bridge_relay_seconds', 'Time to relay a packet', direction.latency.snapshot(), labels)
+                for conn in (bridge.connection_a, bridge.connection_b):
+                    metrics.add_connection(conn.stats(), {'reflector': str(conn.reflector_callsign).strip(), 'module': str(conn.reflector_module)})
+            exporter.register(collect)
+
+            try:
+                while True:
+                    bridge.read()
+            except (DisconnectedError, KeyboardInterrupt):
+                pass
+            for direction in (bridge.a_to_b, bridge.b_to_a):
+                logger.info('%s -> %s: %d packets, added latency mean %.3f ms, p99 %.3f ms, max %.3f ms',
+                            direction.source.reflector_callsign, direction.target.reflector_callsign, direction.packet_count,
+                            direction.latency.mean * 1000, direction.latency.percentile(99) * 1000, direction.latency.maximum * 1000)
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+def main():
+    dv_bridge()
+
+if __name__ == '__main__':
+    dv_bridge()
@@ -0,0 +1,104 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import socket
+import threading
+import time
+import Queue
+
+from dextra import DExtraConnection, DExtraOpenConnection
+from dplus import DPlusConnection
+from stream import DisconnectedError
+from network import NetworkAddress
+from utils import resolve
+
+PROTOCOLS = {'dextra': DExtraConnection,
+             'dextraopen': DExtraOpenConnection,
+             'dplus': DPlusConnection}
+
+def connection_classes(protocol):
+    # Connection classes to try for a protocol name (all of them for auto)
+    if protocol == 'auto':
+        return [DPlusConnection, DExtraConnection, DExtraOpenConnection]
+    if protocol in PROTOCOLS:
+        return [PROTOCOLS[protocol]]
+    raise ValueError
+
+def _open(conn, results):
+    try:
+        opened = conn.open()
+    except DisconnectedError:
+        opened = False
+    except Exception as e:
+        conn.logger.error('can not connect: %s', str(e))
+        opened = False
+    results.put((conn, opened))
+
+def _discard(conn):
+    if conn.sock.sock is None: # Never opened
+        return
+    # The reflector may have accepted the link already, so unlink, but do not wait for an acknowledgement
+    try:
+        conn.write(conn.disconnect_packet())
+    except socket.error:
+        pass
+    conn.disconnected = True
+    conn.close()
+
+def connect(callsign, module, reflector_callsign, reflector_module, host, classes, retries=3, retry_period=1, setup=None):
+    # Starts the handshake of all given connection classes in parallel and returns the first
+    # connection that succeeds (open), cancelling the rest. The host is resolved only once.
+    # If given, setup is called with each connection before it is opened.
+    logger = logging.getLogger('connect')
+
+    for attempt in xrange(retries):
+        if attempt:
+            time.sleep(retry_period)
+        try:
+            address = resolve(host)
+        except ValueError:
+            logger.warning('can not find address for host %s', host)
+            continue
+
+        clock = time.time()
+        candidates = [cls(callsign, module, reflector_callsign, reflector_module, NetworkAddress(address, cls.DEFAULT_PORT))
+                      for cls in classes]
+        if setup:
+            for conn in candidates:
+                setup(conn)
+        results = Queue.Queue()
+        for conn in candidates:
+            thread = threading.Thread(target=_open, args=(conn, results), name='Connect-%s' % conn.__class__.__name__)
+            thread.daemon = True
+            thread.start()
+
+        winner = None
+        for i in xrange(len(candidates)):
+            conn, opened = results.get()
+            if opened and winner is None:
+                winner = conn
+                logger.info('connected to %s with %s in %.3f s', reflector_callsign, conn.__class__.__name__, time.time() - clock)
+                for other in candidates:
+                    if other is not winner:
+                        other.receive_thread.queue.put(None) # Makes a pending handshake fail immediately
+            elif opened:
+                conn.close()
+            else:
+                _discard(conn)
+        if winner is not None:
+            return winner
+    raise Exception('can not connect to %s at %s' % (reflector_callsign, host))
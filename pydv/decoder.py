@@ -19,19 +19,169 @@ import sys
 import argparse
 import logging
 import wave
-import struct
-
-import pydv.mbelib
-import pydv.codec2
+import time
+import math
+import array
+import multiprocessing
+import threading
+import Queue
 
 from stream import DVHeaderPacket, DVFramePacket
 from dvtool import DVToolFile
+from vocoder import Vocoder, FRAMES_PER_SUPERFRAME, DVDecoder, superframe_chunks, vocoder_from_flag, vocoder_description
+
+def _decode_chunk(args):
+    vocoder, frames, warmup = args
+    decoder = DVDecoder(vocoder)
+    # Run through the overlapping frames to let the vocoder state converge and drop their output
+    for dvcodec in frames[:warmup]:
+        decoder.decode(dvcodec)
+    decoder.bit_count = 0
+    decoder.bit_errors = 0
+    data = ''.join([decoder.decode(dvcodec) for dvcodec in frames[warmup:]])
+    return data, decoder.bit_count, decoder.bit_errors
+
+def decode_frames(vocoder, frames, packet_ids=None, jobs=1, chunk_size=50 * FRAMES_PER_SUPERFRAME, overlap=FRAMES_PER_SUPERFRAME):
+    # Returns (data, bit_count, bit_errors)
+    if jobs <= 1:
+        return _decode_chunk((vocoder, frames, 0))
+
+    if packet_ids is None:
+        packet_ids = [i % FRAMES_PER_SUPERFRAME for i in xrange(len(frames))]
+    tasks = [(vocoder, frames[warmup_start:end], start - warmup_start)
+             for warmup_start, start, end in superframe_chunks(packet_ids, chunk_size, overlap)]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_decode_chunk, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return (''.join([data for data, _, _ in results]),
+            sum([bit_count for _, bit_count, _ in results]),
+            sum([bit_errors for _, _, bit_errors in results]))
+
+def compare_samples(reference, data):
+    # Returns (differing samples, maximum difference, SNR in dB) of data against reference
+    reference = array.array('h', reference)
+    data = array.array('h', data)
+    if sys.byteorder != 'little':
+        reference.byteswap()
+        data.byteswap()
+
+    differing = 0
+    max_difference = 0
+    signal_power = 0
+    noise_power = 0
+    for r, d in zip(reference, data):
+        difference = abs(r - d)
+        if difference:
+            differing += 1
+            max_difference = max(max_difference, difference)
+        signal_power += r * r
+        noise_power += difference * difference
+    if noise_power == 0:
+        snr = float('inf')
+    elif signal_power == 0:
+        snr = float('-inf')
+    else:
+        snr = 10 * math.log10(float(signal_power) / noise_power)
+    return differing, max_difference, snr
+
+class DecodePipeline(object):
+    # Reader, decoder and writer stages connected with bounded queues,
+    # so memory use does not depend on the length of the recording.
+    def __init__(self, queue_size=50, buffer_size=50 * 320):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.packet_queue = Queue.Queue(queue_size)
+        self.data_queue = Queue.Queue(queue_size)
+        self.buffer_size = buffer_size
+        self.decoder = None
+        self.frame_count = 0
+        self.errors = []
+
+    def _read(self, dvtool_file):
+        try:
+            for packet in dvtool_file.iterate():
+                self.packet_queue.put(packet)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.packet_queue.put(None)
+
+    def _decode(self):
+        try:
+            while True:
+                packet = self.packet_queue.get()
+                if packet is None:
+                    break
+                if self.decoder is None:
+                    if not isinstance(packet, DVHeaderPacket):
+                        raise ValueError('first packet in stream is not a header')
+                    try:
+                        vocoder = vocoder_from_flag(packet.dstar_header.flag_3)
+                    except ValueError:
+                        raise ValueError('unrecognized flag in stream header')
+                    self.logger.info('stream encoded with %s', vocoder_description(vocoder))
+                    self.decoder = DVDecoder(vocoder)
+                    continue
+                if not isinstance(packet, DVFramePacket):
+                    continue
+                self.data_queue.put(self.decoder.decode(packet.dstar_frame.dvcodec))
+                self.frame_count += 1
+        except Exception as e:
+            self.errors.append(e)
+            # Keep the reader going until it finishes
+            while self.packet_queue.get() is not None:
+                pass
+        finally:
+            self.data_queue.put(None)
+
+    def _write(self, write, flush):
+        done = False
+        while not done:
+            chunks = [self.data_queue.get()]
+            if chunks[0] is None:
+                break
+            # Batch whatever is already available, but never wait for more
+            size = len(chunks[0])
+            while size < self.buffer_size:
+                try:
+                    data = self.data_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if data is None:
+                    done = True
+                    break
+                chunks.append(data)
+                size += len(data)
+            write(''.join(chunks))
+            if flush:
+                flush()
+
+    def run(self, dvtool_file, write, flush=None):
+        threads = [threading.Thread(target=self._read, name='DecodePipelineReader', args=(dvtool_file,)),
+                   threading.Thread(target=self._decode, name='DecodePipelineDecoder')]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._write(write, flush)
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
 
 def dv_decoder():
     parser = argparse.ArgumentParser(description='D-STAR decoder. Decodes streams into samples.')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
-    parser.add_argument('input', help='name of file to decode (DVTool format)')
-    parser.add_argument('output', help='name of file to write (WAV format)')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='number of parallel decoding processes (split at superframe boundaries)')
+    parser.add_argument('-c', '--chunk', default=50, type=int, help='superframes per chunk when decoding in parallel')
+    parser.add_argument('-w', '--overlap', default=1, type=int, help='superframes decoded before each chunk to re-converge the vocoder state')
+    parser.add_argument('--compare', default=False, action='store_true', help='also decode serially and report difference and speedup')
+    parser.add_argument('-r', '--raw', default=False, action='store_true', help='write raw samples (16-bit little endian, 8000 samples/sec) instead of WAV')
+    parser.add_argument('input', help='name of file to decode (DVTool format, - for stdin)')
+    parser.add_argument('output', help='name of file to write (WAV format, - for raw samples to stdout)')
     args = parser.parse_args()
 
     logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
@@ -39,98 +189,118 @@ def dv_decoder():
                         level=logging.DEBUG if args.verbose else logging.INFO)
     logger = logging.getLogger(os.path.basename(sys.argv[0]))
 
+    if args.jobs < 1 or args.chunk < 1 or args.overlap < 0:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.jobs == 1 and not args.compare:
+        dv_decoder_streaming(args, logger)
+    else:
+        dv_decoder_parallel(args, logger)
+
+def dv_decoder_streaming(args, logger):
+    pipeline = DecodePipeline()
+    start_time = time.time()
+    try:
+        with DVToolFile(args.input, sys.stdin if args.input == '-' else None) as f:
+            if args.output == '-':
+                pipeline.run(f, sys.stdout.write, sys.stdout.flush)
+            elif args.raw:
+                with open(args.output, 'wb') as outf:
+                    pipeline.run(f, outf.write)
+            else:
+                wavef = wave.open(args.output, 'w')
+                wavef.setnchannels(1)
+                wavef.setsampwidth(2)
+                wavef.setframerate(8000)
+                try:
+                    pipeline.run(f, wavef.writeframes)
+                finally:
+                    wavef.close()
+    except ValueError as e:
+        logger.error(str(e) or 'can not read %s: invalid DVTool data' % args.input)
+        sys.exit(1)
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if pipeline.decoder is None:
+        logger.error('no stream in input')
+        sys.exit(1)
+
+    elapsed = time.time() - start_time
+    logger.info('decoded %d frames in %.3f seconds (%.1fx real time)',
+                pipeline.frame_count, elapsed, (pipeline.frame_count * 0.02) / elapsed if elapsed else float('inf'))
+    if pipeline.decoder.vocoder == Vocoder.CODEC2_2400:
+        logger.info('total FEC bits: %d, bit errors: %d', pipeline.decoder.bit_count, pipeline.decoder.bit_errors)
+    logger.info('output written to %s', args.output)
+
+def dv_decoder_parallel(args, logger):
     try:
-        with DVToolFile(args.input) as f:
+        with DVToolFile(args.input, sys.stdin if args.input == '-' else None) as f:
             stream = f.read()
+    except ValueError as e:
+        logger.error(str(e) or 'can not read %s: invalid DVTool data' % args.input)
+        sys.exit(1)
     except Exception as e:
-        raise
         logger.error(str(e))
         sys.exit(1)
+    if not stream:
+        logger.error('no stream in input')
+        sys.exit(1)
 
     header = stream[0]
     if not isinstance(header, DVHeaderPacket):
         logger.error('first packet in stream is not a header')
         sys.exit(1)
 
-    # Determine vocoder (SV9OAN extension)
-    version = header.dstar_header.flag_3 & 0xff
-    if version == 0:
-        vocoder = 'ambe'
-        logger.info('stream encoded with AMBE vocoder')
-    elif version & 0x01 == 0x01:
-        # The first bit controls the vocoder type:
-        #   0: AMBE (backwards compatible)
-        #   1: Codec 2
-        #
-        # The second bit differentiates between modes:
-        #   0: Codec 2 3200 (160 samples/20 ms into 64 bits)
-        #   1: Codec 2 2400 (160 samples/20 ms into 48 bits) + FEC (22 bits)
-        #
-        # With Codec 2 2400, we are protecting the first 24 bits of the
-        # voice datawith two applications of the (23, 12) Golay code.
-        vocoder = 'codec2'
-        mode = 0 if (version & 0x03 == 0x01) else 1
-        codec2_mode = pydv.codec2.CODEC2_MODE_2400 if mode == 1 else pydv.codec2.CODEC2_MODE_3200
-        logger.info('stream encoded with Codec 2 vocoder (mode: %s, fec: %s)',
-                    '2400' if mode == 1 else '3200',
-                    'on' if mode == 1 else 'off')
-
-    wavef = wave.open(args.output, 'w')
-    wavef.setnchannels(1)
-    wavef.setsampwidth(2)
-    wavef.setframerate(8000)
-
-    if vocoder == 'ambe':
-        state = pydv.mbelib.init_state()
-        for packet in stream:
-            if not isinstance(packet, DVFramePacket):
-                continue
-            samples = pydv.mbelib.decode_dstar(state, packet.dstar_frame.dvcodec)
-            data = struct.pack('<160h', *samples)
-            wavef.writeframes(data)
+    try:
+        vocoder = vocoder_from_flag(header.dstar_header.flag_3)
+    except ValueError:
+        logger.error('unrecognized flag in stream header')
+        sys.exit(1)
+    logger.info('stream encoded with %s', vocoder_description(vocoder))
+
+    packets = [packet for packet in stream if isinstance(packet, DVFramePacket)]
+    frames = [packet.dstar_frame.dvcodec for packet in packets]
+    packet_ids = [packet.packet_id for packet in packets]
+
+    start_time = time.time()
+    data, bit_count, bit_errors = decode_frames(vocoder,
+                                                frames,
+                                                packet_ids,
+                                                jobs=args.jobs,
+                                                chunk_size=args.chunk * FRAMES_PER_SUPERFRAME,
+                                                overlap=args.overlap * FRAMES_PER_SUPERFRAME)
+    elapsed = time.time() - start_time
+    logger.info('decoded %d frames in %.3f seconds using %d process(es) (%.1fx real time)',
+                len(frames), elapsed, args.jobs, (len(frames) * 0.02) / elapsed if elapsed else float('inf'))
+    if vocoder == Vocoder.CODEC2_2400:
+        logger.info('total FEC bits: %d, bit errors: %d', bit_count, bit_errors)
+
+    if args.compare:
+        start_time = time.time()
+        serial_data, _, _ = decode_frames(vocoder, frames)
+        serial_elapsed = time.time() - start_time
+        differing, max_difference, snr = compare_samples(serial_data, data)
+        speedup = serial_elapsed / elapsed if elapsed else float('inf')
+        logger.info('serial decoding took %.3f seconds, speedup %.2fx (%.2fx per process)',
+                    serial_elapsed, speedup, speedup / args.jobs)
+        logger.info('difference from serial decoding: %d of %d samples differ, maximum difference %d, SNR %.1f dB',
+                    differing, len(serial_data) / 2, max_difference, snr)
+
+    if args.output == '-':
+        sys.stdout.write(data)
+        sys.stdout.flush()
+    elif args.raw:
+        with open(args.output, 'wb') as f:
+            f.write(data)
     else:
-        state = pydv.codec2.codec2_create(codec2_mode)
-        bit_count = 0
-        bit_errors = 0
-        if mode == 1:
-            pydv.codec2.golay23_init()
-        for packet in stream:
-            if not isinstance(packet, DVFramePacket):
-                continue
-
-            dvcodec = packet.dstar_frame.dvcodec
-            if mode == 1:
-                received_codeword = ((ord(dvcodec[0]) << 15) |
-                                     (((ord(dvcodec[1]) >> 4) & 0xF) << 11) |
-                                     (ord(dvcodec[6]) << 3) |
-                                     ((ord(dvcodec[7]) >> 5) & 0x7))
-                corrected_codeword = pydv.codec2.golay23_decode(received_codeword)
-                bit_count += 23
-                bit_errors += pydv.codec2.golay23_count_errors(received_codeword, corrected_codeword)
-
-                corrected_dvcodec = chr((corrected_codeword >> 15) & 0xFF)
-                partial_byte = ((corrected_codeword >> 11) & 0xF) << 4
-
-                received_codeword = (((ord(dvcodec[1]) & 0xF) << 19) |
-                                     (ord(dvcodec[2]) << 11) |
-                                     ((ord(dvcodec[7]) & 0x1F) << 6) |
-                                     ((ord(dvcodec[8]) >> 2) & 0x3F))
-                corrected_codeword = pydv.codec2.golay23_decode(received_codeword)
-                bit_count += 23
-                bit_errors += pydv.codec2.golay23_count_errors(received_codeword, corrected_codeword)
-
-                corrected_dvcodec += chr(partial_byte | ((corrected_codeword >> 19) & 0xF))
-                corrected_dvcodec += chr((corrected_codeword >> 11) & 0xFF)
-
-                dvcodec = corrected_dvcodec + dvcodec[3:]
-
-            dvcodec = dvcodec[:6] if mode == 1 else dvcodec[:8]
-            data = pydv.codec2.codec2_decode(state, dvcodec)
-            wavef.writeframes(data)
-        if mode == 1:
-            logger.info('total FEC bits: %d, bit errors: %d', bit_count, bit_errors)
-
-    wavef.close()
+        wavef = wave.open(args.output, 'w')
+        wavef.setnchannels(1)
+        wavef.setsampwidth(2)
+        wavef.setframerate(8000)
+        wavef.writeframes(data)
+        wavef.close()
     logger.info('output written to %s', args.output)
 
 def main():
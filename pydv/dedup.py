@@ -0,0 +1,122 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import time
+import zlib
+
+from collections import OrderedDict
+
+from stream import DVHeaderPacket, DVFramePacket
+
+class _DedupStream(object):
+    __slots__ = ['source', 'callsign', 'checksum', 'frame_count', 'packets', 'duplicate', 'last_activity']
+
+    def __init__(self, source, callsign, header, clock):
+        self.source = source
+        self.callsign = callsign
+        self.checksum = 0
+        self.frame_count = 0
+        self.packets = [header] # Held back until the fingerprint is complete
+        self.duplicate = None # Unknown until the fingerprint is complete
+        self.last_activity = clock
+
+class StreamDeduplicator(object):
+    # Recognizes the same transmission arriving more than once (e.g. through linked reflectors),
+    # where stream IDs and repeater callsigns differ, but the voice data does not. Streams are
+    # fingerprinted by the originating callsign and a checksum of their first frames. Packets
+    # of a stream are held back until its fingerprint is complete, and dropped if the same
+    # fingerprint was seen from another source within the time window (from the same source,
+    # it is the same operator transmitting again).
+    def __init__(self, frame_count=5, window=10, max_fingerprints=1024, max_streams=256):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.frame_count = frame_count
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.max_streams = max_streams
+
+        self.fingerprints = OrderedDict() # fingerprint -> (time, source), oldest first
+        self.streams = {} # (source, stream_id) -> stream
+
+        self.stream_count = 0
+        self.duplicate_count = 0
+        self.dropped_count = 0
+
+    def _expire(self, clock):
+        while self.fingerprints:
+            fingerprint, (seen, _) = next(self.fingerprints.iteritems())
+            if clock - seen <= self.window and len(self.fingerprints) <= self.max_fingerprints:
+                break
+            del self.fingerprints[fingerprint]
+
+        if len(self.streams) > self.max_streams:
+            # Streams that never ended
+            for key, stream in self.streams.items():
+                if clock - stream.last_activity > self.window:
+                    del self.streams[key]
+
+    def _decide(self, stream, clock):
+        fingerprint = (stream.callsign, stream.frame_count, stream.checksum)
+        seen = self.fingerprints.get(fingerprint)
+        stream.duplicate = seen is not None and seen[1] != stream.source
+        if stream.duplicate:
+            # Left in place, as the order is by the time the fingerprint was stored
+            self.duplicate_count += 1
+            self.logger.info('dropping duplicate stream from %s', stream.callsign)
+        else:
+            self.fingerprints.pop(fingerprint, None) # Moved to the end, with the new time
+            self.fingerprints[fingerprint] = (clock, stream.source)
+        self._expire(clock)
+
+        packets = stream.packets
+        stream.packets = None
+        return [] if stream.duplicate else packets
+
+    def submit(self, packet, source=None):
+        # Returns the packets to keep, which may include previously held back packets of the same stream
+        clock = time.time()
+        if isinstance(packet, DVHeaderPacket):
+            key = (source, packet.stream_id)
+            if key in self.streams:
+                return [] # Repeated header
+            self.streams[key] = _DedupStream(source, str(packet.dstar_header.my_callsign).strip(), packet, clock)
+            self.stream_count += 1
+            self._expire(clock)
+            return []
+
+        if not isinstance(packet, DVFramePacket):
+            return [packet]
+
+        key = (source, packet.stream_id)
+        stream = self.streams.get(key)
+        if stream is None:
+            # No header to fingerprint
+            self.dropped_count += 1
+            return []
+        stream.last_activity = clock
+        if packet.is_last:
+            del self.streams[key]
+
+        if stream.duplicate is None:
+            stream.packets.append(packet)
+            if not packet.is_last:
+                stream.checksum = zlib.crc32(packet.dstar_frame.dvcodec, stream.checksum)
+                stream.frame_count += 1
+            if stream.frame_count < self.frame_count and not packet.is_last:
+                return []
+            return self._decide(stream, clock)
+        return [] if stream.duplicate else [packet]
@@ -99,7 +99,7 @@ class DExtraConnectNackPacket(Packet):
 
     def __init__(self, src_callsign, src_module, dest_module):
         self.src_callsign = src_callsign
-        self.src_callsign = src_module
+        self.src_module = src_module
         self.dest_module = dest_module
 
     @classmethod
@@ -177,7 +177,8 @@ class DExtraConnectionRecieveThread(StreamReceiveThread):
         except ValueError:
             pass
         else:
-            self.logger.debug('received dvframe packet from stream %s%s', packet.stream_id, ' (last)' if packet.is_last else '')
+            if self.debug:
+                self.logger.debug('received dvframe packet from stream %s%s', packet.stream_id, ' (last)' if packet.is_last else '')
             return packet
 
         try:
@@ -185,7 +186,8 @@ class DExtraConnectionRecieveThread(StreamReceiveThread):
         except ValueError:
             pass
         else:
-            self.logger.debug('received dvheader packet from stream %s', packet.stream_id)
+            if self.debug:
+                self.logger.debug('received dvheader packet from stream %s', packet.stream_id)
             return packet
 
         try:
@@ -226,10 +228,12 @@ class DExtraConnectionRecieveThread(StreamReceiveThread):
             pass
         else:
             # self.logger.debug('received keepalive packet from %s', packet.src_callsign)
+            self._keepalive_received()
             keepalive_packet = DExtraKeepAlivePacket(self.callsign)
             self.sock.write(keepalive_packet.to_data())
             return
 
+        self.unknown_count += 1
         self.logger.warning('unknown data received')
 
 class DExtraConnection(ReflectorConnection):
@@ -246,8 +250,11 @@ class DExtraConnection(ReflectorConnection):
             return True
         return False
 
+    def disconnect_packet(self):
+        return DExtraDisconnectPacket(self.callsign, self.module)
+
     def _disconnect(self, timeout=3):
-        self.write(DExtraDisconnectPacket(self.callsign, self.module))
+        self.write(self.disconnect_packet())
         return True if self._read(timeout, [DExtraDisconnectAckPacket]) else False
 
 class DExtraOpenConnection(DExtraConnection):
@@ -36,7 +36,7 @@ class DPlusLoginPacket(Packet):
     @classmethod
     def from_data(cls, data):
         or_valueerror(len(data) == 28)
-        login, callsign, _, serial = struct.unpack('4s8s8s8s', data[4:])
+        login, callsign, _, serial = struct.unpack('4s8s8s8s', data)
         or_valueerror(login == '\x1c\xc0\x04\x00')
         callsign = DSTARCallsign(callsign)
         return cls(callsign, serial)
@@ -115,7 +115,8 @@ class DPlusConnectionRecieveThread(StreamReceiveThread):
         except ValueError:
             pass
         else:
-            self.logger.debug('received dvframe packet from stream %s%s', packet.dv_frame.stream_id, ' (last)' if packet.dv_frame.is_last else '')
+            if self.debug:
+                self.logger.debug('received dvframe packet from stream %s%s', packet.dv_frame.stream_id, ' (last)' if packet.dv_frame.is_last else '')
             return packet
 
         try:
@@ -123,7 +124,8 @@ class DPlusConnectionRecieveThread(StreamReceiveThread):
         except ValueError:
             pass
         else:
-            self.logger.debug('received dvheader packet from stream %s', packet.dv_header.stream_id)
+            if self.debug:
+                self.logger.debug('received dvheader packet from stream %s', packet.dv_header.stream_id)
             return packet
 
         try:
@@ -172,10 +174,12 @@ class DPlusConnectionRecieveThread(StreamReceiveThread):
             pass
         else:
             # self.logger.debug('received keepalive packet')
+            self._keepalive_received()
             keepalive_packet = DPlusKeepAlivePacket()
             self.sock.write(keepalive_packet.to_data())
             return
 
+        self.unknown_count += 1
         self.logger.warning('unknown data received')
 
 class DPlusConnection(ReflectorConnection):
@@ -197,8 +201,11 @@ class DPlusConnection(ReflectorConnection):
             return True
         return False
 
+    def disconnect_packet(self):
+        return DPlusDisconnectPacket()
+
     def _disconnect(self, timeout=3):
-        self.write(DPlusDisconnectPacket())
+        self.write(self.disconnect_packet())
         return True if self._read(timeout, [DPlusDisconnectPacket]) else False
 
     def read(self, timeout=3):
@@ -206,13 +213,16 @@ class DPlusConnection(ReflectorConnection):
         if not packet:
             return None
         if isinstance(packet, DPlusHeaderPacket):
-            return packet.dv_header
-        if isinstance(packet, DPlusFramePacket):
-            return packet.dv_frame
-
-    def write(self, packet):
+            inner = packet.dv_header
+        elif isinstance(packet, DPlusFramePacket):
+            inner = packet.dv_frame
+        if self.receive_thread.stage_latency is not None:
+            inner.stamps = packet.stamps
+        return inner
+
+    def packet_data(self, packet):
         if isinstance(packet, DVHeaderPacket):
             packet = DPlusHeaderPacket(packet)
         elif isinstance(packet, DVFramePacket):
             packet = DPlusFramePacket(packet)
-        return self.sock.write(packet.to_data())
+        return packet.to_data()
@@ -21,15 +21,23 @@ from stream import DVHeaderPacket, DVFramePacket
 from utils import or_valueerror
 
 class DVToolFile(object):
-    def __init__(self, name):
+    # Packet count written when streaming to a file that can not be rewound
+    UNKNOWN_COUNT = 0xffffffff
+
+    def __init__(self, name, fileobj=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.debug('initialized with name %s', name)
 
         self.name = name
+        self.fileobj = fileobj # Already open file (i.e., a pipe), not closed when done
         self.f = None
 
     def open(self):
         or_valueerror(self.f is None)
+        if self.fileobj is not None:
+            self.f = self.fileobj
+            self.logger.debug('using open file %s', self.name)
+            return True
         try:
             self.f = open(self.name, 'a+b')
         except Exception as e:
@@ -39,7 +47,7 @@ class DVToolFile(object):
         return True
 
     def close(self):
-        if self.f:
+        if self.f and self.f is not self.fileobj:
             self.f.close()
         self.f = None
         self.logger.debug('closed file %s', self.name)
@@ -61,14 +69,52 @@ class DVToolFile(object):
             self.f.write(struct.pack('<H', 56 if i == 0 else 27) + packet.to_data())
         self.logger.info('wrote a stream of %s packets in %s', len(stream), self.name)
 
+    def start(self):
+        # Write packets incrementally with append(), then call finish()
+        try:
+            self.f.seek(0)
+            self.f.truncate()
+        except IOError:
+            pass # Not seekable
+
+        self.f.write('DVTOOL' + struct.pack('<I', DVToolFile.UNKNOWN_COUNT))
+        self.count = 0
+
+    def append(self, packets):
+        self.f.write(''.join([struct.pack('<H', 56 if (self.count == 0 and i == 0) else 27) + packet.to_data()
+                              for i, packet in enumerate(packets)]))
+        self.f.flush()
+        self.count += len(packets)
+
+    def finish(self):
+        # The file is opened for appending, so fix the count through another handle
+        if self.fileobj is None:
+            self.f.flush()
+            with open(self.name, 'r+b') as f:
+                f.seek(6)
+                f.write(struct.pack('<I', self.count))
+        self.logger.info('wrote a stream of %s packets in %s', self.count, self.name)
+
     def read(self):
-        self.f.seek(0)
+        return list(self.iterate())
+
+    def iterate(self):
+        # Read packets one by one, instead of loading the whole stream in memory
+        try:
+            self.f.seek(0)
+        except IOError:
+            pass # Not seekable
 
-        stream = []
-        magic, count = struct.unpack('<6sI', self.f.read(10))
+        data = self.f.read(10)
+        or_valueerror(len(data) == 10)
+        magic, count = struct.unpack('<6sI', data)
         or_valueerror(magic == 'DVTOOL')
-        for i in xrange(count):
-            size, = struct.unpack('<H', self.f.read(2))
+        i = 0
+        while i < count:
+            size_data = self.f.read(2)
+            if len(size_data) < 2:
+                break
+            size, = struct.unpack('<H', size_data)
             data = self.f.read(size)
             if i == 0:
                 or_valueerror(size == 56)
@@ -76,6 +122,8 @@ class DVToolFile(object):
             else:
                 or_valueerror(size == 27)
                 packet = DVFramePacket.from_data(data)
-            stream.append(packet)
-        self.logger.info('read a stream of %s packets from %s', len(stream), self.name)
-        return stream
+            yield packet
+            i += 1
+        if i < count:
+            self.logger.warning('stream in %s ended after %s of %s packets', self.name, i, count)
+        self.logger.info('read a stream of %s packets from %s', i, self.name)
@@ -20,18 +20,95 @@ import argparse
 import logging
 import wave
 
-import pydv.codec2
-
 from dstar import DSTARHeader, DSTARFrame, DSTARCallsign, DSTARSuffix
 from stream import DVHeaderPacket, DVFramePacket
 from dvtool import DVToolFile
+from vocoder import Vocoder, FRAMES_PER_SUPERFRAME, DVEncoder, vocoder_flag, vocoder_description
+
+FRAME_SIZE = 320 # 160 samples of 16 bits
+
+class StreamEncoder(object):
+    # Incremental encoder: feed it samples in chunks of any size and get back
+    # the packets for all complete frames, then call finish() at end of stream.
+    def __init__(self, vocoder, stream_id=0, dstar_header=None):
+        self.encoder = DVEncoder(vocoder)
+        self.stream_id = stream_id
+        if dstar_header is None:
+            dstar_header = DSTARHeader(0,
+                                       0,
+                                       0,
+                                       DSTARCallsign('NOCALL'),
+                                       DSTARCallsign('NOCALL'),
+                                       DSTARCallsign('NOCALL'),
+                                       DSTARCallsign('NOCALL'),
+                                       DSTARSuffix('    '))
+        dstar_header.flag_3 = vocoder_flag(vocoder)
+        self.header = DVHeaderPacket(0, 0, 0, self.stream_id, dstar_header)
+
+        self.buffer = ''
+        self.packet_id = 0
+        self.finished = False
+
+    def _packet(self, data, last=False):
+        packet_id = self.packet_id % FRAMES_PER_SUPERFRAME
+        dstar_frame = DSTARFrame(self.encoder.encode(data), '\x55\x2d\x16' if packet_id == 0 else '')
+        self.packet_id += 1
+        return DVFramePacket(0, 0, 0, self.stream_id, packet_id | (64 if last else 0), dstar_frame)
+
+    def encode(self, data):
+        self.buffer += data
+        count = len(self.buffer) // FRAME_SIZE
+        packets = [self._packet(self.buffer[i * FRAME_SIZE:(i + 1) * FRAME_SIZE]) for i in xrange(count)]
+        self.buffer = self.buffer[count * FRAME_SIZE:]
+        return packets
+
+    def finish(self):
+        # Pad any remaining samples with silence, then terminate the stream with
+        # a silent frame marked as last, as frames are sent out without waiting
+        # to know whether more samples will follow.
+        if self.finished:
+            return []
+        packets = []
+        if self.buffer:
+            packets.append(self._packet(self.buffer.ljust(FRAME_SIZE, '\x00')))
+            self.buffer = ''
+        packets.append(self._packet('\x00' * FRAME_SIZE, last=True))
+        self.finished = True
+        return packets
+
+def encode_samples(chunks, vocoder, stream_id=0, dstar_header=None):
+    # Yield the header and then batches of frame packets, while consuming an iterator of sample chunks
+    stream_encoder = StreamEncoder(vocoder, stream_id, dstar_header)
+    yield [stream_encoder.header]
+    for data in chunks:
+        packets = stream_encoder.encode(data)
+        if packets:
+            yield packets
+    yield stream_encoder.finish()
+
+def read_wave(wavef, frames=FRAMES_PER_SUPERFRAME):
+    while True:
+        data = wavef.readframes(frames * (FRAME_SIZE / 2))
+        if not data:
+            break
+        yield data
+
+def read_raw(f, size=FRAMES_PER_SUPERFRAME * FRAME_SIZE):
+    # Use the file descriptor directly, to get samples from pipes as soon as they are available
+    fd = f.fileno()
+    while True:
+        data = os.read(fd, size)
+        if not data:
+            break
+        yield data
 
 def dv_encoder():
     parser = argparse.ArgumentParser(description='D-STAR encoder. Encodes samples into streams.')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
     parser.add_argument('-m', '--mode', default='3200', help='vocoder mode (3200: Codec 2 mode 3200, 2400: Codec 2 mode 2400 with FEC)')
-    parser.add_argument('input', help='name of file to encode (WAV format)')
-    parser.add_argument('output', help='name of file to write (DVTool format)')
+    parser.add_argument('-r', '--raw', default=False, action='store_true', help='read raw samples (16-bit little endian, 8000 samples/sec) instead of WAV')
+    parser.add_argument('input', help='name of file to encode (WAV format, - for raw samples from stdin)')
+    parser.add_argument('output', help='name of file to write (DVTool format, - for stdout, in which case the packet count in the header can not be filled in and is left at 0xffffffff, so readers must read until the end of the stream)')
     args = parser.parse_args()
 
     logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
@@ -42,66 +119,35 @@ def dv_encoder():
     if args.mode not in ('3200', '2400'):
         logger.error('mode can be either 3200 or 2400')
         sys.exit(1)
-    mode = 0 if args.mode == '3200' else 1
-
-    wavef = wave.open(args.input, 'r')
-    if (wavef.getnchannels() != 1 or wavef.getsampwidth() != 2 or wavef.getframerate() != 8000):
-        logger.error('input file must have 1 channel, 16 bits/sample, and 8000 samples/sec')
+    vocoder = Vocoder.CODEC2_3200 if args.mode == '3200' else Vocoder.CODEC2_2400
+
+    inputf = None
+    if args.input == '-':
+        chunks = read_raw(sys.stdin)
+    elif args.raw:
+        inputf = open(args.input, 'rb')
+        chunks = read_raw(inputf)
+    else:
+        inputf = wave.open(args.input, 'r')
+        if (inputf.getnchannels() != 1 or inputf.getsampwidth() != 2 or inputf.getframerate() != 8000):
+            logger.error('input file must have 1 channel, 16 bits/sample, and 8000 samples/sec')
+            sys.exit(1)
+        chunks = read_wave(inputf)
+
+    logger.info('encoding stream with %s', vocoder_description(vocoder))
+
+    try:
+        with DVToolFile(args.output, sys.stdout if args.output == '-' else None) as f:
+            f.start()
+            for packets in encode_samples(chunks, vocoder):
+                f.append(packets)
+            f.finish()
+    except Exception as e:
+        logger.error(str(e))
         sys.exit(1)
-
-    version = 0x01
-    if mode == 1:
-        version |= 0x02
-    dstar_header = DSTARHeader(0,
-                               0,
-                               version,
-                               DSTARCallsign('NOCALL'),
-                               DSTARCallsign('NOCALL'),
-                               DSTARCallsign('NOCALL'),
-                               DSTARCallsign('NOCALL'),
-                               DSTARSuffix('    '))
-    header = DVHeaderPacket(0, 0, 0, 0, dstar_header)
-    stream = [header]
-    packet_id = 0
-    logger.info('encoding stream with Codec 2 vocoder (mode: %s, fec: %s)',
-                '2400' if mode == 1 else '3200',
-                'on' if mode == 1 else 'off')
-
-    codec2_mode = pydv.codec2.CODEC2_MODE_2400 if mode == 1 else pydv.codec2.CODEC2_MODE_3200
-    state = pydv.codec2.codec2_create(codec2_mode)
-    if mode == 1:
-        pydv.codec2.golay23_init()
-    while True:
-        data = wavef.readframes(160)
-        if len(data) < 160:
-            break
-
-        dvcodec = pydv.codec2.codec2_encode(state, data)
-        if mode == 1:
-            bits = (ord(dvcodec[0]) << 4) | ((ord(dvcodec[1]) >> 4) & 0xF)
-            codeword = pydv.codec2.golay23_encode(bits)
-            dvcodec += chr((codeword >> 3) & 0xFF)
-            partial_byte = (codeword & 0x7) << 5
-
-            bits = ((ord(dvcodec[1]) & 0xF) << 8) | ord(dvcodec[2])
-            codeword = pydv.codec2.golay23_encode(bits)
-            dvcodec += chr(partial_byte | ((codeword >> 6) & 0x1F))
-            dvcodec += chr((codeword & 0x3F) << 2)
-
-        dstar_frame = DSTARFrame(dvcodec, '\x55\x2d\x16' if (packet_id % 21 == 0) else '')
-        packet = DVFramePacket(0, 0, 0, 0, packet_id % 21, dstar_frame)
-        stream.append(packet)
-
-        packet_id += 1
-
-    # Mark last packet
-    packet = stream[-1]
-    packet.packet_id |= 64
-
-    wavef.close()
-
-    with DVToolFile(args.output) as f:
-        f.write(stream)
+    finally:
+        if inputf:
+            inputf.close()
 
 def main():
     dv_encoder()
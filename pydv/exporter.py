@@ -0,0 +1,172 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import threading
+import BaseHTTPServer
+
+from collections import OrderedDict
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in sorted(labels.items()))
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metrics(object):
+    # The samples of one scrape, in the Prometheus text format
+    def __init__(self):
+        self.families = OrderedDict() # name -> (type, help, lines)
+
+    def _family(self, name, kind, help):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help, [])
+        return family[2]
+
+    def add(self, name, kind, help, value, labels=None):
+        if value is None:
+            return
+        self._family(name, kind, help).append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+
+    def add_histogram(self, name, help, snapshot, labels=None):
+        lines = self._family(name, 'histogram', help)
+        labels = labels or {}
+        cumulative = 0
+        for bound, count in snapshot['buckets']:
+            cumulative += count
+            bucket_labels = dict(labels)
+            bucket_labels['le'] = _format_value(bound)
+            lines.append('%s_bucket%s %d' % (name, _format_labels(bucket_labels), cumulative))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(snapshot['sum'])))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), snapshot['count']))
+
+    def add_connection(self, stats, labels=None):
+        # From StreamConnection.stats()
+        socket = stats['socket']
+        self.add('pydv_datagrams_received_total', 'counter', 'Datagrams received', socket['datagrams_in'], labels)
+        self.add('pydv_bytes_received_total', 'counter', 'Bytes received', socket['bytes_in'], labels)
+        self.add('pydv_foreign_datagrams_total', 'counter', 'Datagrams received from other hosts', socket['foreign_datagrams'], labels)
+        self.add('pydv_datagrams_sent_total', 'counter', 'Datagrams sent', socket['datagrams_out'], labels)
+        self.add('pydv_bytes_sent_total', 'counter', 'Bytes sent', socket['bytes_out'], labels)
+        for cls, count in sorted(stats['packets'].items()):
+            packet_labels = dict(labels or {})
+            packet_labels['class'] = cls
+            self.add('pydv_packets_received_total', 'counter', 'Packets received, by class', count, packet_labels)
+        self.add('pydv_unknown_datagrams_total', 'counter', 'Datagrams that could not be parsed', stats['unknown'], labels)
+        self.add('pydv_keepalives_received_total', 'counter', 'Keepalives received', stats['keepalives'], labels)
+        self.add_histogram('pydv_keepalive_interval_seconds', 'Time between keepalives received', stats['keepalive_interval'], labels)
+        self.add('pydv_receive_queue_depth', 'gauge', 'Packets waiting to be read', stats['queue_depth'], labels)
+        self.add('pydv_receive_queue_depth_max', 'gauge', 'Most packets ever waiting to be read', stats['max_queue_depth'], labels)
+        self.add_histogram('pydv_read_latency_seconds', 'Time from receiving a packet to reading it', stats['read_latency'], labels)
+        self.add('pydv_idle_seconds', 'gauge', 'Time since anything was received', stats['idle'], labels)
+        if stats.get('stages'):
+            for stage, snapshot in sorted(stats['stages']['stages'].items()):
+                stage_labels = dict(labels or {})
+                stage_labels['stage'] = stage
+                self.add_histogram('pydv_stage_latency_seconds', 'Time packets spend in each stage, from the socket to the application', snapshot, stage_labels)
+        if 'ping_rtt' in stats:
+            self.add('pydv_ambed_busy_total', 'counter', 'Busy replies from AMBEd', stats['busy'], labels)
+            self.add('pydv_ambed_timeouts_total', 'counter', 'Requests to AMBEd that got no reply', stats['timeouts'], labels)
+            self.add_histogram('pydv_ambed_ping_rtt_seconds', 'AMBEd ping round trip time', stats['ping_rtt'], labels)
+
+    def add_link(self, stats, labels=None):
+        # From LinkSupervisor.stats()
+        self.add('pydv_link_up', 'gauge', 'Whether the link is up', 1 if stats['connection'] else 0, labels)
+        self.add('pydv_link_uptime_seconds', 'gauge', 'Time since the link was last (re)connected', stats['uptime'], labels)
+        self.add('pydv_link_availability_ratio', 'gauge', 'Fraction of time the link has been up', stats['availability'], labels)
+        self.add('pydv_link_reconnects_total', 'counter', 'Times the link was reconnected', stats['reconnects'], labels)
+        self.add('pydv_link_recovery_seconds', 'gauge', 'Mean time to reconnect the link', stats['recovery_time'], labels)
+        if stats['connection']:
+            self.add_connection(stats['connection'], labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, samples) in self.families.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            data = self.server.exporter.collect()
+        except Exception as e:
+            self.server.exporter.logger.error('can not collect metrics: %s', str(e))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        self.server.exporter.logger.debug(format, *args)
+
+class MetricsExporter(object):
+    # Serves metrics over HTTP, only to the local host by default (or not at all if port is None).
+    # Collectors are called with a Metrics object when a scrape arrives, and read the counters kept
+    # by each component as they are, so nothing is done on the packet path.
+    def __init__(self, port, address='127.0.0.1'):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.address = (address, port)
+        self.collectors = []
+        self.server = None
+        self.thread = None
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        metrics = Metrics()
+        for collector in self.collectors:
+            collector(metrics)
+        return metrics.render()
+
+    def open(self):
+        if self.address[1] is None: # Disabled
+            return
+        self.server = BaseHTTPServer.HTTPServer(self.address, _MetricsRequestHandler)
+        self.server.exporter = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('serving metrics at http://%s:%s/metrics', *self.server.server_address)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
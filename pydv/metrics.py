@@ -0,0 +1,120 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import bisect
+
+from collections import OrderedDict
+
+# Bucket upper bounds in seconds, doubling from 10 us to about 84 s
+TIME_BUCKETS = [0.00001 * 2 ** i for i in xrange(24)]
+
+class Histogram(object):
+    # Counts values in fixed buckets, so adding is cheap and memory is constant.
+    # Percentiles are interpolated within the bucket they fall in.
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last bucket is for values above all bounds
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        # Adds the values of another histogram with the same bounds
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.maximum
+                return min(lower + (upper - lower) * (rank - seen) / count, self.maximum)
+            seen += count
+        return self.maximum
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'mean': self.mean,
+                'max': self.maximum,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': zip(self.bounds + [float('inf')], self.counts)}
+
+# Intervals between the timestamps of a packet: received, parsed, queued (just before it is put in the queue, so the
+# put counts as time in the queue), read by the application, and consumed
+STAGES = ['parse', 'enqueue', 'queue', 'consume', 'total']
+
+class StageLatency(object):
+    # Latency of each stage packets go through, for a connection and for each of its most recent streams
+    def __init__(self, max_streams=64):
+        self.max_streams = max_streams
+        self.stages = [Histogram() for stage in STAGES]
+        self.streams = OrderedDict() # Stream ID -> histograms, oldest first
+
+    def add(self, stream_id, stamps):
+        intervals = [stamps[i + 1] - stamps[i] for i in xrange(len(stamps) - 1)]
+        intervals.append(stamps[-1] - stamps[0])
+        for histogram, interval in zip(self.stages, intervals):
+            histogram.add(interval)
+        if stream_id is None:
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            if len(self.streams) == self.max_streams:
+                self.streams.popitem(last=False)
+            stream = self.streams[stream_id] = [Histogram() for stage in STAGES]
+        for histogram, interval in zip(stream, intervals):
+            histogram.add(interval)
+
+    def snapshot(self):
+        return {'stages': dict((stage, histogram.snapshot()) for stage, histogram in zip(STAGES, self.stages)),
+                'streams': dict((stream_id, dict((stage, histogram.snapshot()) for stage, histogram in zip(STAGES, histograms)))
+                                for stream_id, histograms in self.streams.items())}
+
+    def report(self):
+        # Lines of text, with percentiles in milliseconds
+        lines = ['%-8s %8s %8s %8s %8s %8s' % ('stage', 'packets', 'p50', 'p90', 'p99', 'max')]
+        for stage, histogram in zip(STAGES, self.stages):
+            lines.append('%-8s %8d %8.3f %8.3f %8.3f %8.3f' % (stage, histogram.count, histogram.percentile(50) * 1000,
+                                                               histogram.percentile(90) * 1000, histogram.percentile(99) * 1000,
+                                                               histogram.maximum * 1000))
+        for stream_id, histograms in self.streams.items():
+            total = histograms[-1]
+            worst = max(zip(STAGES[:-1], histograms[:-1]), key=lambda item: item[1].percentile(99))
+            lines.append('stream %s: %d packets, total p50 %.3f p99 %.3f max %.3f ms, slowest stage %s (p99 %.3f ms)' %
+                         (stream_id, total.count, total.percentile(50) * 1000, total.percentile(99) * 1000, total.maximum * 1000,
+                          worst[0], worst[1].percentile(99) * 1000))
+        return lines
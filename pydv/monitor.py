@@ -0,0 +1,352 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import sys
+import argparse
+import logging
+import socket
+import select
+import signal
+import time
+import wave
+import threading
+import multiprocessing
+import Queue
+
+from contextlib import closing
+
+from dstar import DSTARCallsign, DSTARModule
+from stream import DisconnectedError, DVHeaderPacket, DVFramePacket, consumed
+from connect import connection_classes, connect
+from vocoder import DVDecoder, vocoder_from_flag, vocoder_description
+from exporter import MetricsExporter
+from tracing import add_trace_arguments, setup_tracing
+
+class FileSink(object):
+    # One WAV file per stream (closed after stream_timeout seconds without samples, if the stream never ends).
+    # Files are named after the time the stream started and a counter, as stream IDs get reused.
+    def __init__(self, directory, stream_timeout=10):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.directory = directory
+        self.stream_timeout = stream_timeout
+        self.files = {}
+        self.last_activity = {}
+        self.file_count = 0
+
+    def write(self, stream_id, data, last):
+        clock = time.time()
+        wavef = self.files.get(stream_id)
+        if wavef is None:
+            for key, last_activity in self.last_activity.items():
+                if clock - last_activity > self.stream_timeout:
+                    self.files.pop(key).close()
+                    del self.last_activity[key]
+            self.file_count += 1
+            name = os.path.join(self.directory, '%s-%d-%s.wav' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(clock)), self.file_count, stream_id))
+            wavef = wave.open(name, 'w')
+            wavef.setnchannels(1)
+            wavef.setsampwidth(2)
+            wavef.setframerate(8000)
+            self.files[stream_id] = wavef
+            self.logger.info('writing stream %s to %s', stream_id, name)
+        wavef.writeframes(data)
+        self.last_activity[stream_id] = clock
+        if last:
+            wavef.close()
+            del self.files[stream_id]
+            del self.last_activity[stream_id]
+
+    def close(self):
+        for wavef in self.files.values():
+            wavef.close()
+        self.files = {}
+        self.last_activity = {}
+
+class PipeSink(object):
+    # Raw samples of all streams, in order of arrival
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, stream_id, data, last):
+        self.f.write(data)
+        self.f.flush()
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+class SocketSink(object):
+    # Raw samples of all streams to every client connected to a local (UNIX) socket
+    def __init__(self, path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.path = path
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+        self.clients = []
+
+    def _accept(self):
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return
+            client, _ = self.sock.accept()
+            client.setblocking(False)
+            self.clients.append(client)
+            self.logger.info('client connected to %s', self.path)
+
+    def write(self, stream_id, data, last):
+        self._accept()
+        for client in self.clients[:]:
+            try:
+                client.sendall(data)
+            except socket.error:
+                # Clients that can not keep up are dropped
+                client.close()
+                self.clients.remove(client)
+                self.logger.info('client disconnected from %s', self.path)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.sock.close()
+        os.unlink(self.path)
+
+def _expire(streams, clock, stream_timeout):
+    # Forget streams that stopped without a last frame (values are lists, with the last activity time first)
+    for stream_id, entry in streams.items():
+        if clock - entry[0] > stream_timeout:
+            del streams[stream_id]
+
+def _decoder_worker(in_queue, out_queue, sink_dropped, stream_timeout):
+    # The parent process handles interrupts and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    decoders = {} # stream_id -> [last activity, decoder]
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        stream_id, vocoder, dvcodec, last = item
+        clock = time.time()
+        if vocoder is not None:
+            _expire(decoders, clock, stream_timeout)
+            decoders[stream_id] = [clock, DVDecoder(vocoder)]
+            continue
+        entry = decoders.get(stream_id)
+        if entry is None:
+            continue
+        entry[0] = clock
+        try:
+            out_queue.put_nowait((stream_id, entry[1].decode(dvcodec), last))
+        except Queue.Full:
+            with sink_dropped.get_lock():
+                sink_dropped.value += 1
+        if last:
+            del decoders[stream_id]
+
+class DecoderPool(object):
+    # Each stream is decoded by the same worker process, so vocoder state stays
+    # in one place. Submitting never blocks: if a worker is behind, frames are dropped.
+    # Likewise, workers drop decoded frames if the sink is behind.
+    # Streams without frames for stream_timeout seconds are forgotten, here and in the workers.
+    def __init__(self, sink, workers=None, queue_size=500, stream_timeout=10):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.sink = sink
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.in_queues = [multiprocessing.Queue(queue_size) for i in xrange(workers)]
+        self.out_queue = multiprocessing.Queue(queue_size)
+        self.sink_dropped = multiprocessing.Value('L', 0)
+        self.workers = [multiprocessing.Process(target=_decoder_worker, args=(in_queue, self.out_queue, self.sink_dropped, stream_timeout))
+                        for in_queue in self.in_queues]
+        self.sink_thread = threading.Thread(target=self._write, name='DecoderPoolSink')
+
+        self.stream_timeout = stream_timeout
+        self.streams = {} # stream_id -> [last activity, vocoder]
+        self.stream_count = 0
+        self.frame_count = 0
+        self.dropped_count = 0
+        self.decoded_count = 0
+
+    @property
+    def sink_dropped_count(self):
+        return self.sink_dropped.value
+
+    def _write(self):
+        while True:
+            item = self.out_queue.get()
+            if item is None:
+                break
+            self.decoded_count += 1
+            try:
+                self.sink.write(*item)
+            except Exception as e:
+                self.logger.error('can not write samples: %s', str(e))
+
+    def _put(self, stream_id, item):
+        try:
+            self.in_queues[stream_id % len(self.in_queues)].put_nowait(item)
+        except Queue.Full:
+            self.dropped_count += 1
+            return False
+        return True
+
+    def queue_depths(self):
+        # Not available on all platforms
+        try:
+            return [in_queue.qsize() for in_queue in self.in_queues]
+        except NotImplementedError:
+            return []
+
+    def start(self):
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        self.sink_thread.start()
+
+    def stop(self):
+        for in_queue in self.in_queues:
+            in_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.out_queue.put(None)
+        self.sink_thread.join()
+        self.sink.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def submit(self, packet):
+        clock = time.time()
+        if isinstance(packet, DVHeaderPacket):
+            try:
+                vocoder = vocoder_from_flag(packet.dstar_header.flag_3)
+            except ValueError:
+                self.logger.warning('unrecognized flag in header of stream %s', packet.stream_id)
+                return
+            entry = self.streams.get(packet.stream_id)
+            if entry is not None and entry[1] == vocoder:
+                entry[0] = clock # Repeated header
+                return
+            # A new stream, or a stream ID reused with another vocoder
+            _expire(self.streams, clock, self.stream_timeout)
+            self.streams.pop(packet.stream_id, None)
+            if self._put(packet.stream_id, (packet.stream_id, vocoder, None, False)):
+                self.streams[packet.stream_id] = [clock, vocoder]
+                self.stream_count += 1
+                self.logger.info('stream %s from %s encoded with %s', packet.stream_id, str(packet.dstar_header.my_callsign).strip(), vocoder_description(vocoder))
+        elif isinstance(packet, DVFramePacket):
+            entry = self.streams.get(packet.stream_id)
+            if entry is None:
+                return
+            entry[0] = clock
+            if self._put(packet.stream_id, (packet.stream_id, None, packet.dstar_frame.dvcodec, packet.is_last)):
+                self.frame_count += 1
+            if packet.is_last:
+                del self.streams[packet.stream_id]
+
+def dv_monitor():
+    parser = argparse.ArgumentParser(description='D-STAR monitor. Connects to reflector and decodes traffic live.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-p', '--protocol', default='auto', help='network protocol (dextra, dextraopen, dplus, or auto to try all in parallel)')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='number of decoder processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output', default='-', help='where to write samples (- for raw samples to stdout, unix:PATH for a local socket, a directory for WAV files per stream, named TIME-COUNT-STREAMID.wav, or any other file or pipe for raw samples)')
+    parser.add_argument('--metrics-port', default=None, type=int, help='serve metrics in the Prometheus text format at this port on localhost')
+    parser.add_argument('callsign', help='your callsign')
+    parser.add_argument('reflector', help='reflector\'s callsign')
+    parser.add_argument('module', help='reflector\'s module')
+    parser.add_argument('address', help='reflector\'s hostname or IP address')
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    setup_tracing(args)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    try:
+        callsign = DSTARCallsign(args.callsign)
+        reflector_callsign = DSTARCallsign(args.reflector)
+        reflector_module = DSTARModule(args.module)
+        classes = connection_classes(args.protocol)
+        if args.workers is not None and args.workers < 1:
+            raise ValueError
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        if args.output == '-':
+            sink = PipeSink(sys.stdout)
+        elif args.output.startswith('unix:'):
+            sink = SocketSink(args.output[5:])
+        elif os.path.isdir(args.output):
+            sink = FileSink(args.output)
+        else:
+            sink = PipeSink(open(args.output, 'wb'))
+    except Exception as e:
+        logger.error('can not open output: %s', str(e))
+        sys.exit(1)
+
+    try:
+        with MetricsExporter(args.metrics_port) as exporter, DecoderPool(sink, args.workers) as pool:
+            with closing(connect(callsign, DSTARModule(' '), reflector_callsign, reflector_module, args.address, classes)) as conn:
+                def collect(metrics):
+                    metrics.add_connection(conn.stats(), {'reflector': str(reflector_callsign).strip(), 'module': str(reflector_module)})
+                    metrics.add('pydv_monitor_streams_total', 'counter', 'Streams decoded', pool.stream_count)
+                    metrics.add('pydv_monitor_frames_submitted_total', 'counter', 'Frames submitted for decoding', pool.frame_count)
+                    metrics.add('pydv_monitor_frames_decoded_total', 'counter', 'Frames decoded', pool.decoded_count)
+                    metrics.add('pydv_monitor_frames_dropped_total', 'counter', 'Frames dropped because a decoder was behind', pool.dropped_count)
+                    metrics.add('pydv_monitor_decoded_frames_dropped_total', 'counter', 'Decoded frames dropped because the output was behind', pool.sink_dropped_count)
+                    for i, depth in enumerate(pool.queue_depths()):
+                        metrics.add('pydv_monitor_decoder_queue_depth', 'gauge', 'Frames waiting to be decoded', depth, {'worker': i})
+                exporter.register(collect)
+
+                try:
+                    while True:
+                        packet = conn.read()
+                        if packet:
+                            pool.submit(packet)
+                            consumed(packet)
+                except (DisconnectedError, KeyboardInterrupt):
+                    pass
+                if conn.receive_thread.stage_latency is not None:
+                    logger.info('latency of packets until submitted for decoding:')
+                    for line in conn.receive_thread.stage_latency.report():
+                        logger.info(line)
+            logger.info('decoded %d streams, %d frames (%d dropped, %d dropped after decoding)', pool.stream_count, pool.frame_count, pool.dropped_count, pool.sink_dropped_count)
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+def main():
+    dv_monitor()
+
+if __name__ == '__main__':
+    dv_monitor()
@@ -16,11 +16,14 @@
 
 import socket
 import select
+import errno
 import logging
+import time
 
 from collections import namedtuple
 
 from utils import or_valueerror, resolve
+from tracing import TRACE_IN, TRACE_OUT, tracer
 
 _NetworkAddress = namedtuple('NetworkAddress', ['host', 'port'])
 class NetworkAddress(_NetworkAddress):
@@ -43,6 +46,15 @@ class UDPClientSocket(object):
         self.local_address = local_address
 
         self.sock = None
+        self.debug = self.logger.isEnabledFor(logging.DEBUG) # Checked once, not for every datagram
+        self.tracer = None
+        self.trace_source = None
+
+        self.datagrams_in = 0
+        self.bytes_in = 0
+        self.foreign_datagrams = 0 # From other hosts
+        self.datagrams_out = 0
+        self.bytes_out = 0
 
     def open(self):
         or_valueerror(self.sock is None)
@@ -52,6 +64,10 @@ class UDPClientSocket(object):
         self.sock.bind(self.local_address)
         self.logger.debug('socket opened')
 
+        self.tracer = tracer()
+        if self.tracer is not None:
+            self.trace_source = self.tracer.register(str(self.remote_address))
+
     def close(self):
         if self.sock is not None:
             self.sock.close()
@@ -65,6 +81,13 @@ class UDPClientSocket(object):
     def __exit__(self, type, value, traceback):
         self.close()
 
+    def wait(self, timeout=None):
+        # Returns True if there is data to read
+        or_valueerror(self.sock)
+
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
     def read(self, length=1024):
         or_valueerror(self.sock)
 
@@ -74,25 +97,157 @@ class UDPClientSocket(object):
             return None
 
         data, address = self.sock.recvfrom(length)
-        self.logger.debug('read %d bytes from %s: %s', len(data), address, repr(data))
+        if self.debug:
+            self.logger.debug('read %d bytes from %s: %s', len(data), address, repr(data))
 
         # Check if the data is for us, only check the IP address now (used to include port number too)
         if self.remote_address.host != address[0]:
+            self.foreign_datagrams += 1
             return None
 
+        self.datagrams_in += 1
+        self.bytes_in += len(data)
+        if self.tracer is not None:
+            self.tracer.record(self.trace_source, TRACE_IN, data)
         return data
 
     def write(self, data):
         or_valueerror(self.sock)
 
-        self.logger.debug('write %d bytes to %s: %s', len(data), self.remote_address, repr(data))
+        if self.debug:
+            self.logger.debug('write %d bytes to %s: %s', len(data), self.remote_address, repr(data))
+        if self.tracer is not None:
+            self.tracer.record(self.trace_source, TRACE_OUT, data)
         length = self.sock.sendto(data, self.remote_address)
-        self.logger.debug('wrote %d bytes', length)
+        if self.debug:
+            self.logger.debug('wrote %d bytes', length)
+        self.datagrams_out += 1
+        self.bytes_out += length
 
         if length != len(data):
             return False
         return True
 
+    def stats(self):
+        return {'datagrams_in': self.datagrams_in,
+                'bytes_in': self.bytes_in,
+                'foreign_datagrams': self.foreign_datagrams,
+                'datagrams_out': self.datagrams_out,
+                'bytes_out': self.bytes_out}
+
+# Python 2.7 does not define SO_REUSEPORT (this is the value on Linux)
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+class UDPPeer(object):
+    __slots__ = ['address', 'state', 'last_seen', 'datagrams_in', 'bytes_in', 'datagrams_out', 'bytes_out', 'send_failures']
+
+    def __init__(self, address, state=None):
+        self.address = address
+        self.state = state # Anything the owner needs to keep per peer
+        self.last_seen = time.time()
+        self.datagrams_in = 0
+        self.bytes_in = 0
+        self.datagrams_out = 0
+        self.bytes_out = 0
+        self.send_failures = 0
+
+class UDPServerSocket(object):
+    # One socket serving many peers, with a table from (ip, port) to peer state.
+    # With reuse_port, several processes can bind the same port and the kernel
+    # spreads peers across them by hashing their addresses.
+    def __init__(self, local_address, reuse_port=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.debug('initialized with local %s', local_address)
+
+        self.local_address = local_address
+        self.reuse_port = reuse_port
+
+        self.sock = None
+        self.peers = {} # (ip, port) -> peer
+        self.unknown_datagrams = 0
+        self.send_failures = 0
+
+    def open(self):
+        or_valueerror(self.sock is None)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.sock.bind(self.local_address)
+        self.sock.setblocking(False)
+        self.local_address = NetworkAddress(*self.sock.getsockname())
+        self.logger.debug('socket opened at %s', self.local_address)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.logger.debug('socket closed')
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wait(self, timeout):
+        # Returns True if there is data to read
+        readable, writable, exceptional = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def read(self, length=1024):
+        # Returns (data, address, peer), with peer None for unknown addresses, or None if there is no data
+        try:
+            data, address = self.sock.recvfrom(length)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+
+        peer = self.peers.get(address)
+        if peer is None:
+            self.unknown_datagrams += 1
+        else:
+            peer.last_seen = time.time()
+            peer.datagrams_in += 1
+            peer.bytes_in += len(data)
+        return data, address, peer
+
+    def write(self, data, address, peer=None):
+        # A full send buffer drops the datagram, as the network would
+        try:
+            length = self.sock.sendto(data, address)
+        except socket.error:
+            self.send_failures += 1
+            if peer is not None:
+                peer.send_failures += 1
+            return False
+        if peer is not None:
+            peer.datagrams_out += 1
+            peer.bytes_out += length
+        return length == len(data)
+
+    def add_peer(self, address, state=None):
+        peer = UDPPeer(address, state)
+        self.peers[address] = peer
+        return peer
+
+    def remove_peer(self, address):
+        return self.peers.pop(address, None)
+
+    def evict_idle(self, timeout):
+        # Returns the peers removed for not sending anything in timeout seconds
+        limit = time.time() - timeout
+        evicted = [peer for peer in self.peers.itervalues() if peer.last_seen < limit]
+        for peer in evicted:
+            del self.peers[peer.address]
+        return evicted
+
 if __name__ == '__main__':
     import threading
 
@@ -19,19 +19,140 @@ import sys
 import argparse
 import logging
 import random
+import socket
+import threading
 import time
 
-from dstar import DSTARCallsign, DSTARSuffix, DSTARModule
-from dextra import DExtraConnection, DExtraOpenConnection
-from dplus import DPlusConnection
-from stream import DisconnectedError
-from network import NetworkAddress
+from dstar import DSTARCallsign, DSTARSuffix, DSTARModule, DSTARHeader
+from stream import DVHeaderPacket
+from connect import connection_classes, connect
 from dvtool import DVToolFile
+from utils import monotonic
+
+class PlayerTarget(object):
+    # A reflector module to play back to, with its own copy of the header and send counters
+    def __init__(self, protocol, reflector_callsign, reflector_module, address):
+        self.classes = connection_classes(protocol)
+        self.reflector_callsign = reflector_callsign
+        self.reflector_module = reflector_module
+        self.address = address
+
+        self.conn = None
+        self.sent_count = 0
+        self.failed_count = 0
+        self.last_error = None
+
+    @classmethod
+    def from_string(cls, value):
+        # From PROTOCOL,REFLECTOR,MODULE,ADDRESS
+        fields = value.split(',')
+        if len(fields) != 4:
+            raise ValueError
+        return cls(fields[0], DSTARCallsign(fields[1]), DSTARModule(fields[2]), fields[3])
+
+    def __str__(self):
+        return '%s%s at %s' % (str(self.reflector_callsign)[:7], self.reflector_module, self.address)
+
+    def connect(self, callsign):
+        try:
+            self.conn = connect(callsign, DSTARModule(' '), self.reflector_callsign, self.reflector_module, self.address, self.classes)
+        except Exception as e:
+            logging.getLogger('connect').error(str(e))
+
+    def header(self, packet, callsign):
+        # The header of a stream, addressed to this target
+        dstar_header = packet.dstar_header
+        return DVHeaderPacket(packet.band_1, packet.band_2, packet.band_3, packet.stream_id,
+                              DSTARHeader(dstar_header.flag_1,
+                                          dstar_header.flag_2,
+                                          dstar_header.flag_3,
+                                          DSTARCallsign(str(self.reflector_callsign)[:7] + str(self.reflector_module)),
+                                          DSTARCallsign(str(self.reflector_callsign)[:7] + 'G'),
+                                          DSTARCallsign('CQCQCQ'),
+                                          callsign,
+                                          DSTARSuffix('    ')))
+
+    def send(self, data):
+        try:
+            sent = self.conn.sock.write(data)
+            if not sent:
+                self.last_error = 'short write'
+        except socket.error as e:
+            sent = False
+            self.last_error = str(e)
+        if sent:
+            self.sent_count += 1
+        else:
+            self.failed_count += 1
+
+class Player(object):
+    # Plays back streams to connected targets in lockstep, on one clock, a packet every period seconds
+    # (or as fast as possible if period is None). Frames are serialized once for all targets using
+    # the same protocol (headers differ, as they name the reflector).
+    def __init__(self, targets, callsign, period=0.020):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.targets = targets
+        self.callsign = callsign
+        self.period = period
+        self.target_time = 0
+
+        self.packet_count = 0
+        self.start_time = None
+        self.end_time = None
+
+    def send(self, packet):
+        if isinstance(packet, DVHeaderPacket):
+            for target in self.targets:
+                target.send(target.conn.packet_data(target.header(packet, self.callsign)))
+            return
+
+        data = {}
+        for target in self.targets:
+            framing = target.conn.packet_data.im_func # Shared by connection classes with the same wire format
+            if framing not in data:
+                data[framing] = target.conn.packet_data(packet)
+            target.send(data[framing])
+
+    def play(self, stream, stream_id):
+        if self.start_time is None:
+            self.start_time = monotonic()
+        try:
+            for packet in stream:
+                packet.stream_id = stream_id
+                self.send(packet)
+                self.packet_count += 1
+                if self.period is None:
+                    continue
+                if abs(self.target_time - monotonic()) > 1: # Start over when falling too far behind
+                    self.target_time = monotonic()
+                self.target_time += self.period
+                time.sleep(max(self.target_time - monotonic(), 0))
+        finally:
+            self.end_time = monotonic()
+
+    def report(self):
+        elapsed = self.end_time - self.start_time if self.start_time is not None else 0
+        rate = self.packet_count / elapsed if elapsed else 0
+        if self.period is None:
+            self.logger.info('played %d packets in %.1f s, at %.1f packets/s (unpaced)', self.packet_count, elapsed, rate)
+        else:
+            self.logger.info('played %d packets in %.1f s, at %.1f packets/s (target %.1f)', self.packet_count, elapsed, rate, 1 / self.period)
+        for target in self.targets:
+            self.logger.info('%s: sent %d packets, %d failed', target, target.sent_count, target.failed_count)
+            if target.failed_count:
+                self.logger.warning('%s: last send failure: %s', target, target.last_error)
 
 def dv_player():
-    parser = argparse.ArgumentParser(description='D-STAR player. Connects to reflector and plays back recordings.')
+    parser = argparse.ArgumentParser(description='D-STAR player. Connects to reflectors and plays back recordings.')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
-    parser.add_argument('-p', '--protocol', default='auto', help='network protocol (dextra, dextraopen, dplus, or auto)')
+    parser.add_argument('-p', '--protocol', default='auto', help='network protocol (dextra, dextraopen, dplus, or auto to try all in parallel)')
+    parser.add_argument('-l', '--loop', default=1, type=int, help='times to play back the recording, each time with a new stream ID (default: 1, 0 to loop until interrupted)')
+    rate = parser.add_mutually_exclusive_group()
+    rate.add_argument('-s', '--speed', default=None, type=float, help='play back at this many times real time')
+    rate.add_argument('-r', '--rate', default=None, type=float, help='packets per second to send to each reflector')
+    rate.add_argument('-u', '--unpaced', default=False, action='store_true', help='send as fast as possible')
+    parser.add_argument('-t', '--target', default=[], action='append', metavar='PROTOCOL,REFLECTOR,MODULE,ADDRESS', help='another reflector to play back to at the same time (may be given more than once)')
     parser.add_argument('callsign', help='your callsign')
     parser.add_argument('reflector', help='reflector\'s callsign')
     parser.add_argument('module', help='reflector\'s module')
@@ -46,24 +167,10 @@ def dv_player():
 
     try:
         callsign = DSTARCallsign(args.callsign)
-        reflector_callsign = DSTARCallsign(args.reflector)
-        reflector_module = DSTARModule(args.module)
-        if args.protocol == 'dextra':
-            connection_class = DExtraConnection
-        elif args.protocol == 'dextraopen':
-            connection_class = DExtraOpenConnection
-        elif args.protocol == 'dplus':
-            connection_class = DPlusConnection
-        elif args.protocol == 'auto':
-            if str(reflector_callsign).startswith('REF'):
-                connection_class = DPlusConnection
-            elif str(reflector_callsign).startswith('ORF'):
-                connection_class = DExtraOpenConnection
-            else:
-                connection_class = DExtraConnection
-        else:
+        targets = [PlayerTarget(args.protocol, DSTARCallsign(args.reflector), DSTARModule(args.module), args.address)]
+        targets.extend(PlayerTarget.from_string(target) for target in args.target)
+        if args.loop < 0 or (args.speed is not None and args.speed <= 0) or (args.rate is not None and args.rate <= 0):
             raise ValueError
-        reflector_address = NetworkAddress(args.address, connection_class.DEFAULT_PORT)
     except ValueError:
         parser.print_help()
         sys.exit(1)
@@ -75,30 +182,36 @@ def dv_player():
         logger.error(str(e))
         sys.exit(1)
 
-    header = stream[0]
-    header.dstar_header.my_callsign = callsign
-    header.dstar_header.my_suffix = DSTARSuffix('    ')
-    header.dstar_header.ur_callsign = DSTARCallsign('CQCQCQ')
-    header.dstar_header.repeater_1_callsign = DSTARCallsign(str(reflector_callsign)[:7] + str(reflector_module))
-    header.dstar_header.repeater_2_callsign = DSTARCallsign(str(reflector_callsign)[:7] + 'G')
-    stream_id = random.getrandbits(16)
-    target_time = 0
+    threads = [threading.Thread(target=target.connect, args=(callsign,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    connected = [target for target in targets if target.conn is not None]
+    if not connected:
+        logger.error('can not connect to any reflector')
+        sys.exit(1)
 
+    if args.unpaced:
+        period = None
+    elif args.rate:
+        period = 1 / args.rate
+    else:
+        period = 0.020 / (args.speed or 1)
+    player = Player(connected, callsign, period)
+    stream_id = random.getrandbits(16)
     try:
-        with connection_class(callsign, DSTARModule(' '), reflector_callsign, reflector_module, reflector_address) as conn:
-            try:
-                for packet in stream:
-                    packet.stream_id = stream_id
-                    conn.write(packet)
-                    if abs(target_time - time.time()) > 1:
-                        target_time = time.time()
-                    target_time += 0.020
-                    time.sleep(max(target_time - time.time(), 0))
-            except (DisconnectedError, KeyboardInterrupt):
-                pass
-    except Exception as e:
-        logger.error(str(e))
-        sys.exit(1)
+        count = 0
+        while not args.loop or count < args.loop:
+            player.play(stream, stream_id)
+            stream_id = stream_id % 0xffff + 1 # Next one, skipping 0
+            count += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for target in connected:
+            target.conn.close()
+    player.report()
 
 def main():
     dv_player()
@@ -18,74 +18,155 @@ import os
 import sys
 import argparse
 import logging
+import threading
+import functools
+import Queue
 
 from dstar import DSTARCallsign, DSTARModule
-from dextra import DExtraConnection, DExtraOpenConnection
-from dplus import DPlusConnection
-from stream import DisconnectedError, DVHeaderPacket, DVFramePacket
-from network import NetworkAddress
+from stream import DVHeaderPacket, DVFramePacket, consumed
+from connect import connection_classes, connect
 from dvtool import DVToolFile
+from dedup import StreamDeduplicator
+from supervisor import LinkSupervisor
+from timer import scheduler
+from exporter import MetricsExporter
+from tracing import add_trace_arguments, setup_tracing
+from utils import monotonic
+
+def _receive(index, supervisor, queue):
+    # Feeds packets from one of several links to a shared queue
+    while not supervisor.stopped:
+        packet = supervisor.read(1)
+        if packet:
+            queue.put((index, packet))
+
+def _save(stream):
+    with DVToolFile('%s.dvtool' % stream[0].stream_id) as f:
+        f.write(stream)
 
 def dv_recorder():
     parser = argparse.ArgumentParser(description='D-STAR recorder. Connects to reflector and records traffic.')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
-    parser.add_argument('-p', '--protocol', default='auto', help='network protocol (dextra, dplus, or auto)')
+    parser.add_argument('-p', '--protocol', default='auto', help='network protocol (dextra, dextraopen, dplus, or auto to try all in parallel)')
+    parser.add_argument('-a', '--also', nargs=3, action='append', default=[], metavar=('REFLECTOR', 'MODULE', 'ADDRESS'), help='also record from another reflector (can be repeated); transmissions received from more than one reflector are recorded once')
+    parser.add_argument('-d', '--dedup-frames', default=5, type=int, help='number of frames to compare when looking for duplicate transmissions')
+    parser.add_argument('-w', '--dedup-window', default=10.0, type=float, help='time window to look for duplicate transmissions in (s)')
+    parser.add_argument('-e', '--stream-timeout', default=5.0, type=float, help='record streams that stop without a last frame after this long (s)')
+    parser.add_argument('-t', '--timeout', default=30.0, type=float, help='reconnect if nothing is received from a reflector for this long (s)')
+    parser.add_argument('--metrics-port', default=None, type=int, help='serve metrics in the Prometheus text format at this port on localhost')
     parser.add_argument('callsign', help='your callsign')
     parser.add_argument('reflector', help='reflector\'s callsign')
     parser.add_argument('module', help='reflector\'s module')
     parser.add_argument('address', help='reflector\'s hostname or IP address')
+    add_trace_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S',
                         level=logging.DEBUG if args.verbose else logging.INFO)
+    setup_tracing(args)
     logger = logging.getLogger(os.path.basename(sys.argv[0]))
 
     try:
         callsign = DSTARCallsign(args.callsign)
-        reflector_callsign = DSTARCallsign(args.reflector)
-        reflector_module = DSTARModule(args.module)
-        if args.protocol == 'dextra':
-            connection_class = DExtraConnection
-        elif args.protocol == 'dextraopen':
-            connection_class = DExtraOpenConnection
-        elif args.protocol == 'dplus':
-            connection_class = DPlusConnection
-        elif args.protocol == 'auto':
-            if str(reflector_callsign).startswith('REF'):
-                connection_class = DPlusConnection
-            elif str(reflector_callsign).startswith('ORF'):
-                connection_class = DExtraOpenConnection
-            else:
-                connection_class = DExtraConnection
-        else:
+        classes = connection_classes(args.protocol)
+        reflectors = [(DSTARCallsign(reflector), DSTARModule(module), address)
+                      for reflector, module, address in [(args.reflector, args.module, args.address)] + args.also]
+        if args.dedup_frames < 1 or args.dedup_window < 0 or args.timeout <= 0 or args.stream_timeout <= 0:
             raise ValueError
-        reflector_address = NetworkAddress(args.address, connection_class.DEFAULT_PORT)
     except ValueError:
         parser.print_help()
         sys.exit(1)
 
     try:
-        stream_id = None
-        with connection_class(callsign, DSTARModule(' '), reflector_callsign, reflector_module, reflector_address) as conn:
+        deduplicator = StreamDeduplicator(args.dedup_frames, args.dedup_window) if len(reflectors) > 1 else None
+        queue = Queue.Queue()
+        threads = []
+        supervisors = []
+        streams = {} # (connection index, stream_id) -> packets
+        last_activity = {} # (connection index, stream_id) -> time
+
+        def collect(metrics):
+            for (reflector_callsign, reflector_module, _), supervisor in zip(reflectors, supervisors):
+                metrics.add_link(supervisor.stats(), {'reflector': str(reflector_callsign).strip(), 'module': str(reflector_module)})
+            metrics.add('pydv_recorder_streams', 'gauge', 'Streams being recorded', len(streams))
+            metrics.add('pydv_recorder_queue_depth', 'gauge', 'Packets waiting to be recorded', queue.qsize())
+            if deduplicator is not None:
+                metrics.add('pydv_recorder_streams_received_total', 'counter', 'Streams received', deduplicator.stream_count)
+                metrics.add('pydv_recorder_duplicate_streams_total', 'counter', 'Duplicate streams dropped', deduplicator.duplicate_count)
+
+        exporter = MetricsExporter(args.metrics_port)
+        exporter.register(collect)
+        try:
+            exporter.open()
+            for index, (reflector_callsign, reflector_module, address) in enumerate(reflectors):
+                supervisor = LinkSupervisor(functools.partial(connect, callsign, DSTARModule(' '), reflector_callsign, reflector_module, address, classes),
+                                            args.timeout)
+                supervisor.open()
+                supervisors.append(supervisor)
+                thread = threading.Thread(target=_receive, args=(index, supervisor, queue), name='Receive-%s' % reflector_callsign)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
             try:
                 while True:
-                    packet = conn.read()
-                    if isinstance(packet, DVHeaderPacket):
-                        if packet.stream_id != stream_id:
-                            stream_id = packet.stream_id
-                            stream = [packet]
-                    elif isinstance(packet, DVFramePacket):
-                        if packet.stream_id == stream_id:
-                            stream.append(packet)
-                            if packet.is_last:
-                                with DVToolFile('%s.dvtool' % stream_id) as f:
-                                    f.write(stream)
-                                stream_id = None
-                    else:
-                        pass
-            except (DisconnectedError, KeyboardInterrupt):
+                    try:
+                        index, packet = queue.get(True, 1) # Without a timeout, interrupts are ignored
+                    except Queue.Empty:
+                        continue
+
+                    if index is None:
+                        # A stream timer expired, but the stream may have been active since
+                        key = packet
+                        if key not in streams:
+                            continue
+                        idle = monotonic() - last_activity[key]
+                        if idle < args.stream_timeout:
+                            scheduler().schedule(args.stream_timeout - idle, queue.put, (None, key))
+                            continue
+                        stream = streams.pop(key)
+                        del last_activity[key]
+                        logger.warning('stream %s stopped without a last frame after %d frames', key[1], len(stream) - 1)
+                        _save(stream)
+                        continue
+
+                    for packet in (deduplicator.submit(packet, index) if deduplicator is not None else [packet]):
+                        key = (index, packet.stream_id)
+                        if isinstance(packet, DVHeaderPacket):
+                            streams[key] = [packet]
+                            last_activity[key] = monotonic()
+                            scheduler().schedule(args.stream_timeout, queue.put, (None, key))
+                        elif isinstance(packet, DVFramePacket):
+                            stream = streams.get(key)
+                            if stream is not None:
+                                stream.append(packet)
+                                last_activity[key] = monotonic()
+                                if packet.is_last:
+                                    _save(stream)
+                                    del streams[key]
+                                    del last_activity[key]
+                        consumed(packet)
+            except KeyboardInterrupt:
                 pass
+        finally:
+            for supervisor in supervisors:
+                supervisor.stop()
+            for thread in threads:
+                thread.join()
+            for (reflector_callsign, _, _), supervisor in zip(reflectors, supervisors):
+                if supervisor.conn is not None and supervisor.conn.receive_thread.stage_latency is not None:
+                    logger.info('latency of packets from %s, since the link was last (re)connected:', str(reflector_callsign).strip())
+                    for line in supervisor.conn.receive_thread.stage_latency.report():
+                        logger.info(line)
+            for supervisor in reversed(supervisors):
+                supervisor.close()
+            exporter.close()
+        for (reflector_callsign, _, _), supervisor in zip(reflectors, supervisors):
+            logger.info('link to %s: available %.1f%% of the time, %d reconnects, %.1f s mean time to recover',
+                        str(reflector_callsign).strip(), supervisor.availability * 100, supervisor.reconnect_count, supervisor.recovery_time)
+        if deduplicator is not None:
+            logger.info('received %d streams, %d duplicates dropped', deduplicator.stream_count, deduplicator.duplicate_count)
     except Exception as e:
         logger.error(str(e))
         sys.exit(1)
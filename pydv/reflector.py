@@ -0,0 +1,221 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import sys
+import argparse
+import logging
+import string
+import time
+
+from dstar import DSTARCallsign
+from dextra import DExtraConnectPacket, DExtraConnectAckPacket, DExtraConnectNackPacket, DExtraDisconnectPacket, DExtraDisconnectAckPacket, DExtraKeepAlivePacket, DExtraConnection
+from network import NetworkAddress, UDPServerSocket
+from utils import StoppableThread
+from exporter import MetricsExporter
+
+class ReflectorPeer(object):
+    __slots__ = ['callsign', 'module']
+
+    def __init__(self, callsign, module):
+        self.callsign = callsign
+        self.module = module
+
+class DExtraReflector(StoppableThread):
+    # Accepts DExtra links and relays voice packets to all other peers linked to the same module.
+    # Voice packets are relayed as received, so they are never parsed or serialized again.
+    def __init__(self, callsign, address=None, modules=string.ascii_uppercase, keepalive_period=3, peer_timeout=30):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.debug('initialized with callsign %s address %s modules %s', callsign, address, modules)
+
+        StoppableThread.__init__(self, name=self.__class__.__name__)
+        self._sleep_period = 0
+        self.daemon = True
+
+        if address is None:
+            address = NetworkAddress('0.0.0.0', DExtraConnection.DEFAULT_PORT)
+        self.callsign = callsign
+        self.address = address
+        self.keepalive_period = keepalive_period
+        self.peer_timeout = peer_timeout
+
+        self.sock = UDPServerSocket(address)
+        self.modules = dict([(module, []) for module in modules.upper()]) # module -> [peer]
+        self.last_keepalive = 0
+
+        self.packets_in = 0
+        self.packets_out = 0
+
+    @property
+    def peers(self):
+        return self.sock.peers
+
+    def open(self):
+        self.sock.open()
+        self.address = self.sock.local_address
+        self.logger.info('listening at %s', self.address)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        self.open()
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.join()
+        self.close()
+
+    def _link(self, packet, address):
+        module = str(packet.dest_module)
+        if module not in self.modules:
+            self.logger.info('rejected link from %s at %s to module %s', str(packet.src_callsign).strip(), address, module)
+            self.sock.write(DExtraConnectNackPacket.from_connect_packet(packet).to_data(), address)
+            return
+
+        self._unlink(address)
+        peer = self.sock.add_peer(address, ReflectorPeer(packet.src_callsign, module))
+        self.modules[module].append(peer)
+        self.logger.info('%s at %s linked to module %s', str(packet.src_callsign).strip(), address, module)
+        self.sock.write(DExtraConnectAckPacket.from_connect_packet(packet).to_data(), address, peer)
+
+    def _forget(self, peer):
+        self.modules[peer.state.module].remove(peer)
+        self.logger.info('%s at %s unlinked from module %s', str(peer.state.callsign).strip(), peer.address, peer.state.module)
+
+    def _unlink(self, address):
+        peer = self.sock.remove_peer(address)
+        if peer is not None:
+            self._forget(peer)
+
+    def _relay(self, data, peer):
+        write = self.sock.write
+        for target in self.modules[peer.state.module]:
+            if target is not peer:
+                if write(data, target.address, target):
+                    self.packets_out += 1
+
+    def _process(self, data, address, peer):
+        self.packets_in += 1
+
+        # Voice packets first, as these are the most frequent
+        if (len(data) == 27 or len(data) == 56) and data[:4] == 'DSVT':
+            if peer is not None:
+                self._relay(data, peer)
+            return
+
+        try:
+            packet = DExtraKeepAlivePacket.from_data(data)
+        except ValueError:
+            pass
+        else:
+            return # The socket already noted that the peer is alive
+
+        try:
+            packet = DExtraConnectPacket.from_data(data)
+        except ValueError:
+            pass
+        else:
+            self._link(packet, address)
+            return
+
+        try:
+            packet = DExtraDisconnectPacket.from_data(data)
+        except ValueError:
+            pass
+        else:
+            self._unlink(address)
+            self.sock.write(DExtraDisconnectAckPacket().to_data(), address)
+            return
+
+        self.logger.warning('unknown data received from %s', address)
+
+    def _keepalive(self):
+        clock = time.time()
+        if clock - self.last_keepalive < self.keepalive_period:
+            return
+        self.last_keepalive = clock
+
+        for peer in self.sock.evict_idle(self.peer_timeout):
+            self.logger.info('%s at %s timed out', str(peer.state.callsign).strip(), peer.address)
+            self._forget(peer)
+        data = DExtraKeepAlivePacket(self.callsign).to_data()
+        for peer in self.peers.values():
+            self.sock.write(data, peer.address, peer)
+
+    def loop(self):
+        if self.sock.wait(0.1):
+            read = self.sock.read
+            while True:
+                result = read()
+                if result is None:
+                    break
+                self._process(*result)
+        self._keepalive()
+
+def dv_reflector():
+    parser = argparse.ArgumentParser(description='D-STAR reflector. Accepts DExtra links and relays traffic between peers on the same module.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-a', '--address', default='0.0.0.0', help='address to listen at')
+    parser.add_argument('-p', '--port', default=DExtraConnection.DEFAULT_PORT, type=int, help='port to listen at')
+    parser.add_argument('-m', '--modules', default=string.ascii_uppercase, help='modules to accept links to')
+    parser.add_argument('--metrics-port', default=None, type=int, help='serve metrics in the Prometheus text format at this port on localhost')
+    parser.add_argument('callsign', help='reflector\'s callsign')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    try:
+        callsign = DSTARCallsign(args.callsign)
+        if not args.modules or not set(args.modules.upper()).issubset(string.ascii_uppercase):
+            raise ValueError
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        with MetricsExporter(args.metrics_port) as exporter, \
+             DExtraReflector(callsign, NetworkAddress(args.address, args.port), args.modules) as reflector:
+            def collect(metrics):
+                metrics.add('pydv_reflector_packets_received_total', 'counter', 'Packets received', reflector.packets_in)
+                metrics.add('pydv_reflector_packets_sent_total', 'counter', 'Packets sent', reflector.packets_out)
+                metrics.add('pydv_reflector_send_failures_total', 'counter', 'Packets that could not be sent', reflector.sock.send_failures)
+                metrics.add('pydv_reflector_unlinked_datagrams_total', 'counter', 'Datagrams from addresses that are not linked', reflector.sock.unknown_datagrams)
+                for module, peers in sorted(reflector.modules.items()):
+                    metrics.add('pydv_reflector_peers', 'gauge', 'Peers linked', len(peers), {'module': module})
+            exporter.register(collect)
+
+            try:
+                while reflector.is_alive():
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            logger.info('received %d packets, sent %d packets', reflector.packets_in, reflector.packets_out)
+            if not reflector.is_alive():
+                raise Exception('reflector stopped unexpectedly')
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+def main():
+    dv_reflector()
+
+if __name__ == '__main__':
+    dv_reflector()
@@ -0,0 +1,207 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import sys
+import argparse
+import logging
+import random
+import time
+
+from contextlib import closing
+
+from dstar import DSTARCallsign, DSTARModule
+from stream import DVHeaderPacket
+from dplus import DPlusHeaderPacket, DPlusFramePacket, DPlusConnection
+from dextra import DExtraConnection
+from connect import connection_classes, connect
+from network import NetworkAddress, UDPClientSocket
+from dvtool import DVToolFile
+from utils import monotonic
+
+FRAME_PERIOD = 0.020
+
+def sequential_offsets(streams, gap=1):
+    # Start times for playing streams one after the other
+    offsets = []
+    offset = 0
+    for stream in streams:
+        offsets.append(offset)
+        offset += len(stream) * FRAME_PERIOD + gap
+    return offsets
+
+def replay_schedule(streams, offsets, loss=0, jitter=0, seed=0):
+    # Returns the packets of all streams as (time, stream index, sequence, packet), in the order they are to be sent.
+    # Stream i gets stream ID i + 1 and starts at offsets[i]. Frames (never headers) are dropped with probability loss,
+    # and delayed by up to jitter seconds. Everything depends only on the arguments, so the same seed always gives
+    # the same drops, delays and interleaving, whatever the playback speed.
+    rng = random.Random(seed)
+    events = []
+    for index, (stream, offset) in enumerate(zip(streams, offsets)):
+        for sequence, packet in enumerate(stream):
+            packet.stream_id = index + 1
+            if sequence and loss and rng.random() < loss:
+                continue
+            delay = rng.uniform(0, jitter) if jitter else 0
+            events.append((offset + sequence * FRAME_PERIOD + delay, index, sequence, packet))
+    events.sort(key=lambda event: event[:3])
+    return events
+
+def dextra_data(packet):
+    return packet.to_data()
+
+def dplus_data(packet):
+    if isinstance(packet, DVHeaderPacket):
+        return DPlusHeaderPacket(packet).to_data()
+    return DPlusFramePacket(packet).to_data()
+
+class UDPTarget(object):
+    # Sends packets as datagrams to an address, framed as DExtra or DPlus
+    def __init__(self, sock, framing=dextra_data):
+        self.sock = sock
+        self.framing = framing
+
+    def __call__(self, packet):
+        return self.sock.write(self.framing(packet))
+
+class ConnectionTarget(object):
+    # Sends packets through a connection (e.g., linked to a local reflector)
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __call__(self, packet):
+        return self.conn.write(packet)
+
+class ReceivePathTarget(object):
+    # Hands packets to a connection's receive thread, as if they had arrived from the network,
+    # so that whatever reads from the connection sees them. The connection need not be open.
+    # Waits while the connection has more than max_queue_depth packets not yet read.
+    def __init__(self, conn, max_queue_depth=1000):
+        self.receive_thread = conn.receive_thread
+        self.framing = conn.packet_data
+        self.max_queue_depth = max_queue_depth
+
+    def __call__(self, packet):
+        queue = self.receive_thread.queue
+        while queue.qsize() >= self.max_queue_depth:
+            time.sleep(0.001)
+        self.receive_thread.receive(self.framing(packet))
+        return True
+
+class Replayer(object):
+    # Sends scheduled packets to a target at speed times real time, or as fast as possible if speed is None
+    def __init__(self, events, target, speed=1.0):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.events = events
+        self.target = target
+        self.speed = speed
+
+        self.sent_count = 0
+        self.failed_count = 0
+        self.late_time = 0 # Maximum
+        self.elapsed = 0
+
+    @property
+    def duration(self):
+        # Of the replayed traffic, in real time
+        return self.events[-1][0] if self.events else 0
+
+    def run(self):
+        start_time = monotonic()
+        for event_time, index, sequence, packet in self.events:
+            if self.speed:
+                delay = start_time + event_time / self.speed - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > self.late_time:
+                    self.late_time = -delay
+            if self.target(packet):
+                self.sent_count += 1
+            else:
+                self.failed_count += 1
+        self.elapsed = monotonic() - start_time
+        self.logger.info('replayed %d packets (%.1f s of traffic) in %.3f s, %.1f times real time',
+                         self.sent_count, self.duration, self.elapsed, self.duration / self.elapsed if self.elapsed else 0)
+        if self.failed_count:
+            self.logger.warning('%d packets could not be sent', self.failed_count)
+
+def dv_replay():
+    parser = argparse.ArgumentParser(description='D-STAR replay. Plays back recordings to a local endpoint, faster than real time and with reproducible loss and jitter.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-p', '--protocol', default='dextra', choices=['dextra', 'dplus'], help='packet framing (default: dextra)')
+    parser.add_argument('-P', '--port', default=None, type=int, help='port to send to (default: the protocol\'s port)')
+    parser.add_argument('-l', '--link', nargs=3, default=None, metavar=('CALLSIGN', 'REFLECTOR', 'MODULE'), help='link to a reflector at the address, and play back through the link')
+    parser.add_argument('-s', '--speed', default=1.0, type=float, help='times real time to play back at (default: 1, 0 for as fast as possible)')
+    parser.add_argument('-g', '--stagger', default=None, type=float, help='seconds between the start of each recording (default: play one after the other)')
+    parser.add_argument('--loss', default=0, type=float, help='fraction of frames to drop')
+    parser.add_argument('--jitter', default=0, type=float, help='maximum delay to add to each packet, in milliseconds')
+    parser.add_argument('--seed', default=0, type=int, help='seed for loss and jitter')
+    parser.add_argument('address', help='hostname or IP address to send to')
+    parser.add_argument('input', nargs='+', help='names of files to play back (DVTool format)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    try:
+        if args.speed < 0 or not (0 <= args.loss < 1) or args.jitter < 0 or (args.stagger is not None and args.stagger < 0):
+            raise ValueError
+        if args.link:
+            callsign = DSTARCallsign(args.link[0])
+            reflector_callsign = DSTARCallsign(args.link[1])
+            reflector_module = DSTARModule(args.link[2])
+            classes = connection_classes(args.protocol)
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        streams = []
+        for name in args.input:
+            with DVToolFile(name) as f:
+                streams.append(f.read())
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    if args.stagger is None:
+        offsets = sequential_offsets(streams)
+    else:
+        offsets = [i * args.stagger for i in xrange(len(streams))]
+    events = replay_schedule(streams, offsets, args.loss, args.jitter / 1000.0, args.seed)
+
+    try:
+        if args.link:
+            with closing(connect(callsign, DSTARModule(' '), reflector_callsign, reflector_module, args.address, classes)) as conn:
+                Replayer(events, ConnectionTarget(conn), args.speed or None).run()
+        else:
+            port = args.port or (DPlusConnection if args.protocol == 'dplus' else DExtraConnection).DEFAULT_PORT
+            with UDPClientSocket(NetworkAddress(args.address, port)) as sock:
+                Replayer(events, UDPTarget(sock, dplus_data if args.protocol == 'dplus' else dextra_data), args.speed or None).run()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+def main():
+    dv_replay()
+
+if __name__ == '__main__':
+    dv_replay()
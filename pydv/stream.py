@@ -16,15 +16,17 @@
 
 import logging
 import struct
-import time
 import Queue
 
 from dstar import DSTARHeader, DSTARFrame
 from network import UDPClientSocket
-from utils import or_valueerror, StoppableThread
+from utils import or_valueerror, monotonic, StoppableThread
+from timer import scheduler
+from metrics import Histogram, StageLatency
+from tracing import stage_timing, stream_id_of
 
 class Packet(object): # Abstract
-    __slots__ = ['data']
+    __slots__ = ['data', 'received_at', 'stamps'] # Set by the receive thread
 
     def __init__(self, data):
         self.data = data
@@ -110,15 +112,36 @@ class DVFramePacket(Packet):
 class DisconnectedError(Exception):
     pass
 
+class _ReadTimeout(object):
+    # Queued by the scheduler when a read times out
+    __slots__ = []
+
 class StreamReceiveThread(StoppableThread):
     def __init__(self, sock):
         self.logger = logging.getLogger(self.__class__.__name__)
 
         StoppableThread.__init__(self, name=self.__class__.__name__)
-        self._sleep_period = 0.01
+        self._sleep_period = 0
 
         self.sock = sock
         self.queue = Queue.Queue()
+        self.debug = self.logger.isEnabledFor(logging.DEBUG) # For per-packet messages in _process
+        self.last_activity = monotonic() # When data was last received
+
+        self.packet_counts = {} # Class -> count of packets queued
+        self.unknown_count = 0
+        self.max_queue_depth = 0
+        self.keepalive_count = 0
+        self.keepalive_interval = Histogram()
+        self.last_keepalive = None
+        self.stage_latency = StageLatency() if stage_timing() else None
+
+    def _keepalive_received(self):
+        # Called by subclasses that answer keepalives themselves
+        if self.last_keepalive is not None:
+            self.keepalive_interval.add(self.last_activity - self.last_keepalive)
+        self.last_keepalive = self.last_activity
+        self.keepalive_count += 1
 
     def _process(self, data): # Abstract
         if not data:
@@ -126,17 +149,43 @@ class StreamReceiveThread(StoppableThread):
         return Packet.from_data(data)
 
     def loop(self):
+        # Block until there is data, waking up only to check if the thread should stop
+        if not self.sock.wait(0.1):
+            return
         while True: # While there is data to read from the socket
             data = self.sock.read()
             if not data:
                 return
+            self.receive(data)
 
-            try:
-                packet = self._process(data)
-                if packet:
-                    self.queue.put(packet)
-            except DisconnectedError:
-                self.queue.put(None)
+    def receive(self, data):
+        # Handles a datagram read from the socket (or replayed, without one)
+        clock = self.last_activity = monotonic()
+
+        try:
+            packet = self._process(data)
+            if packet:
+                packet.received_at = clock
+                if self.stage_latency is not None:
+                    parsed = monotonic()
+                    stream_id = stream_id_of(data)
+                    # Stamped as enqueued before the put, as the reader may get the packet before the put returns
+                    packet.stamps = [self.stage_latency, stream_id, clock, parsed, monotonic()]
+                self.queue.put(packet)
+                cls = packet.__class__
+                self.packet_counts[cls] = self.packet_counts.get(cls, 0) + 1
+                depth = self.queue.qsize()
+                if depth > self.max_queue_depth:
+                    self.max_queue_depth = depth
+        except DisconnectedError:
+            self.queue.put(None)
+
+def consumed(packet):
+    # Applications call this when done with a packet they read, to time the last stage (if timing stages)
+    stamps = getattr(packet, 'stamps', None)
+    if stamps is not None:
+        packet.stamps = None
+        stamps[0].add(stamps[1], stamps[2:] + [monotonic()])
 
 class StreamConnection(object):
     def __init__(self, address):
@@ -148,26 +197,51 @@ class StreamConnection(object):
         self.sock = UDPClientSocket(self.address)
         self.receive_thread = StreamReceiveThread(self.sock)
         self.disconnected = False
+        self.read_latency = Histogram() # From receiving a packet to returning it from read
+
+    def _consumed(self, packet):
+        received_at = getattr(packet, 'received_at', None)
+        if received_at is not None:
+            clock = monotonic()
+            self.read_latency.add(clock - received_at)
+            if self.receive_thread.stage_latency is not None:
+                packet.stamps.append(clock)
+        return packet
 
     def _read(self, timeout=3, expected_packet_classes=None):
-        step = 0.01
-        clock = time.time()
-        limit = clock + timeout
-        while (clock < limit):
-            try:
-                packet = self.receive_thread.queue.get(True, step)
+        # Block on the queue until a packet arrives, or the scheduler queues the timeout marker.
+        # The timed get is a backstop, in case the marker never comes.
+        queue = self.receive_thread.queue
+        timeout_marker = None
+        timer = None
+        try:
+            while True:
+                try:
+                    packet = queue.get_nowait()
+                except Queue.Empty:
+                    if timer is None:
+                        timeout_marker = _ReadTimeout()
+                        deadline = monotonic() + timeout
+                        timer = scheduler().schedule_at(deadline, queue.put, timeout_marker)
+                    try:
+                        packet = queue.get(True, max(deadline - monotonic(), 0))
+                    except Queue.Empty:
+                        return None
+                if packet is timeout_marker:
+                    return None
+                if isinstance(packet, _ReadTimeout): # From an earlier read
+                    continue
                 if not packet:
                     self.disconnected = True
                     raise DisconnectedError
                 if expected_packet_classes is None:
-                    return packet
+                    return self._consumed(packet)
                 for cls in expected_packet_classes:
                     if isinstance(packet, cls):
-                        return packet
-            except Queue.Empty:
-                pass
-            clock = time.time()
-        return None
+                        return self._consumed(packet)
+        finally:
+            if timer is not None:
+                timer.cancel()
 
     def _connect(self):
         return True
@@ -200,6 +274,21 @@ class StreamConnection(object):
         self.sock.close()
         self.logger.info('disconnected from %s', self.address)
 
+    def stats(self):
+        # Snapshot of counters and histograms, as a dictionary
+        thread = self.receive_thread
+        return {'address': str(self.address),
+                'socket': self.sock.stats(),
+                'packets': dict((cls.__name__, count) for cls, count in thread.packet_counts.items()),
+                'unknown': thread.unknown_count,
+                'keepalives': thread.keepalive_count,
+                'keepalive_interval': thread.keepalive_interval.snapshot(),
+                'queue_depth': thread.queue.qsize(),
+                'max_queue_depth': thread.max_queue_depth,
+                'read_latency': self.read_latency.snapshot(),
+                'stages': thread.stage_latency.snapshot() if thread.stage_latency is not None else None,
+                'idle': monotonic() - thread.last_activity}
+
     def __enter__(self):
         if not self.open():
             raise Exception('can not open connection to %s' % (self.address,))
@@ -211,8 +300,12 @@ class StreamConnection(object):
     def read(self, timeout=3):
         return self._read(timeout)
 
+    def packet_data(self, packet):
+        # Packet as written to the network
+        return packet.to_data()
+
     def write(self, packet):
-        return self.sock.write(packet.to_data())
+        return self.sock.write(self.packet_data(packet))
 
 class ReflectorConnection(StreamConnection):
     def __init__(self, callsign, module, reflector_callsign, reflector_module, reflector_address):
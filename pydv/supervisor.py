@@ -0,0 +1,172 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import random
+import socket
+import threading
+
+from stream import DisconnectedError
+from timer import scheduler
+from utils import monotonic
+
+class LinkSupervisor(object):
+    # Keeps a reflector link up. The link is declared dead when the reflector disconnects, or when
+    # nothing (not even a keepalive) has been received for timeout seconds. Then it is reconnected,
+    # retrying with jittered exponential backoff, until it succeeds or the supervisor is stopped.
+    # Connect is a callable returning an open connection (e.g. a partial of connect.connect).
+    def __init__(self, connect, timeout=30, backoff=1, max_backoff=60):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.connect = connect
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.conn = None
+        self.watchdog = None
+        self.timed_out = False
+        self._stop_event = threading.Event()
+
+        self.started_at = None
+        self.connected_at = None
+        self.connected_time = 0 # Total, excluding the current link
+        self.reconnect_count = 0
+        self.recovery_times = [] # Seconds from each failure to the link being up again
+
+    @property
+    def uptime(self):
+        # Time since the link was last (re)connected
+        if self.conn is None:
+            return 0
+        return monotonic() - self.connected_at
+
+    @property
+    def availability(self):
+        if self.started_at is None:
+            return 0
+        elapsed = monotonic() - self.started_at
+        return (self.connected_time + self.uptime) / elapsed if elapsed else 1.0
+
+    @property
+    def recovery_time(self):
+        # Mean time to recover
+        if not self.recovery_times:
+            return 0
+        return sum(self.recovery_times) / len(self.recovery_times)
+
+    @property
+    def stopped(self):
+        return self._stop_event.isSet()
+
+    def open(self):
+        # The first connection is not retried, so that configuration errors are reported
+        self.started_at = monotonic()
+        self._up(self.connect())
+
+    def stop(self):
+        # Makes pending and future reads return immediately
+        self._stop_event.set()
+
+    def close(self):
+        self.stop()
+        if self.conn is not None:
+            self.watchdog.cancel()
+            self.connected_time += self.uptime
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _watch(self, conn):
+        # Runs in the scheduler thread, when the link would time out if nothing was received meanwhile
+        if conn is not self.conn:
+            return
+        idle = monotonic() - conn.receive_thread.last_activity
+        if idle < self.timeout:
+            self.watchdog = scheduler().schedule(self.timeout - idle, self._watch, conn)
+            return
+        self.timed_out = True
+        conn.receive_thread.queue.put(None) # Makes the pending (or next) read raise DisconnectedError
+
+    def _up(self, conn):
+        self.conn = conn
+        self.connected_at = monotonic()
+        self.timed_out = False
+        self.watchdog = scheduler().schedule(self.timeout, self._watch, conn)
+
+    def _fail(self, reason):
+        self.logger.warning('link to %s is down (%s), up for %.1f s', self.conn.reflector_callsign, reason, self.uptime)
+        self.watchdog.cancel()
+        self.connected_time += self.uptime
+        conn = self.conn
+        self.conn = None
+        # The reflector may still think the link is up, so unlink, but do not wait for an acknowledgement
+        try:
+            conn.write(conn.disconnect_packet())
+        except socket.error:
+            pass
+        conn.disconnected = True
+        conn.close()
+        return conn.reflector_callsign
+
+    def _reconnect(self, reflector_callsign):
+        clock = monotonic()
+        delay = self.backoff
+        while not self._stop_event.isSet():
+            try:
+                conn = self.connect()
+            except Exception as e:
+                wait = random.uniform(delay / 2.0, delay)
+                self.logger.warning('can not reconnect to %s (%s), retrying in %.1f s', reflector_callsign, str(e), wait)
+                self._stop_event.wait(wait)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            if self._stop_event.isSet():
+                conn.close()
+                return
+            self._up(conn)
+            self.reconnect_count += 1
+            self.recovery_times.append(self.connected_at - clock)
+            self.logger.info('link to %s is up again after %.1f s', reflector_callsign, self.connected_at - clock)
+            return
+
+    def read(self, timeout=3):
+        # Like the connection's read, but reconnects instead of raising DisconnectedError
+        if self.conn is None or self._stop_event.isSet():
+            return None
+        try:
+            return self.conn.read(timeout)
+        except DisconnectedError:
+            self._reconnect(self._fail('nothing received for %d s' % self.timeout if self.timed_out else 'disconnected by reflector'))
+            return None
+
+    def stats(self):
+        return {'uptime': self.uptime,
+                'availability': self.availability,
+                'reconnects': self.reconnect_count,
+                'recovery_time': self.recovery_time,
+                'connection': self.conn.stats() if self.conn is not None else None}
+
+    def write(self, packet):
+        if self.conn is None:
+            return False
+        return self.conn.write(packet)
@@ -0,0 +1,162 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import atexit
+import fcntl
+import errno
+import logging
+import select
+import threading
+import heapq
+
+from utils import monotonic
+
+class Timer(object):
+    __slots__ = ['scheduler', 'deadline', 'callback', 'args', 'cancelled']
+
+    def __init__(self, scheduler, deadline, callback, args):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+class TimerScheduler(threading.Thread):
+    # Runs callbacks at deadlines (on the monotonic clock) from a single thread, so that
+    # connections and stream tables do not need to wake up periodically to check for them.
+    # Timers are kept in a heap. Cancelled timers stay there until they expire, or until they
+    # are more than half of the heap. While no timer is due, the thread blocks in select.
+    # Callbacks should be short (e.g. put something in a queue), as they delay other timers.
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+
+        self.lock = threading.Lock()
+        self.timers = []
+        self.cancelled_count = 0
+        self.wake_at = None # When the thread is going to wake up (None if not sleeping or no timers)
+        self.stopped = False
+
+        # Writing to the pipe wakes up the thread
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def _wake(self):
+        try:
+            os.write(self.wake_write, '\x00')
+        except OSError as e:
+            if e.errno != errno.EAGAIN: # The pipe is full, so the thread is waking up anyway
+                raise
+
+    def schedule(self, delay, callback, *args):
+        return self.schedule_at(monotonic() + delay, callback, *args)
+
+    def schedule_at(self, deadline, callback, *args):
+        timer = Timer(self, deadline, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers, timer)
+            wake = self.timers[0] is timer and (self.wake_at is None or deadline < self.wake_at)
+            if wake:
+                self.wake_at = deadline
+        if wake:
+            self._wake()
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            self.cancelled_count += 1
+            if self.cancelled_count > len(self.timers) / 2:
+                self.timers = [timer for timer in self.timers if not timer.cancelled]
+                heapq.heapify(self.timers)
+                self.cancelled_count = 0
+
+    def stop(self):
+        self.stopped = True
+        self._wake()
+
+    def run(self):
+        while not self.stopped:
+            due = []
+            with self.lock:
+                clock = monotonic()
+                while self.timers and (self.timers[0].cancelled or self.timers[0].deadline <= clock):
+                    timer = heapq.heappop(self.timers)
+                    if timer.cancelled:
+                        self.cancelled_count -= 1
+                    else:
+                        timer.cancelled = True # Cancelling from now on is a no-op
+                        due.append(timer)
+                if due:
+                    timeout = 0
+                    self.wake_at = None
+                elif self.timers:
+                    timeout = self.timers[0].deadline - clock
+                    self.wake_at = self.timers[0].deadline
+                else:
+                    timeout = None
+                    self.wake_at = None
+
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self.logger.error('timer callback failed: %s', str(e))
+            if due:
+                continue
+
+            try:
+                readable, _, _ = select.select([self.wake_read], [], [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if readable:
+                try:
+                    os.read(self.wake_read, 4096)
+                except OSError:
+                    pass
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def scheduler():
+    # The scheduler shared by all users in the process, started on first use
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = TimerScheduler()
+            _scheduler.start()
+            atexit.register(_stop_scheduler, _scheduler)
+        return _scheduler
+
+def _stop_scheduler(scheduler):
+    # Stop the thread before the interpreter tears down the modules it uses
+    scheduler.stop()
+    scheduler.join(1)
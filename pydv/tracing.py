@@ -0,0 +1,202 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+import sys
+import argparse
+import logging
+import signal
+import struct
+import threading
+import time
+import itertools
+import binascii
+
+from utils import monotonic
+
+TRACE_IN = 0
+TRACE_OUT = 1
+
+_MAGIC = 'PYDVTRC1'
+_FILE_HEADER = struct.Struct('<dHH') # Wall clock minus monotonic clock, source count, record size
+_RECORD_HEADER = struct.Struct('<dBBH') # Monotonic clock, direction, source, length
+_MAX_DATA = 64 # Enough for any D-STAR packet, longer datagrams are truncated
+_RECORD_SIZE = _RECORD_HEADER.size + _MAX_DATA
+
+def stream_id_of(data):
+    # Stream ID of a DExtra or DPlus voice packet, or None
+    if data[:4] == 'DSVT':
+        offset = 12
+    elif data[2:6] == 'DSVT':
+        offset = 14
+    else:
+        return None
+    if len(data) < offset + 2:
+        return None
+    return struct.unpack_from('<H', data, offset)[0]
+
+class PacketTracer(object):
+    # Keeps the last capacity datagrams sent or received in a preallocated buffer of fixed-size records,
+    # so recording a packet is a couple of copies and nothing is written anywhere until dumped.
+    # Only one in every sample datagrams is kept, and if stream_id is set, only that stream's voice packets.
+    # Records are claimed with a shared counter, so sockets in different threads can record concurrently.
+    def __init__(self, capacity=4096, sample=1, stream_id=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.capacity = capacity
+        self.sample = sample
+        self.stream_id = stream_id
+
+        self.buffer = bytearray(capacity * _RECORD_SIZE)
+        self.sources = [] # Index -> label
+        self._sources_lock = threading.Lock()
+        self._seen = itertools.count()
+        self._index = itertools.count()
+
+    def register(self, label):
+        # Returns the source number to record with (the same for sockets reopened to the same address)
+        with self._sources_lock:
+            if label in self.sources:
+                return self.sources.index(label)
+            if len(self.sources) == 255:
+                return 255
+            self.sources.append(label)
+            return len(self.sources) - 1
+
+    def record(self, source, direction, data):
+        if self.stream_id is not None and stream_id_of(data) != self.stream_id:
+            return
+        if self.sample > 1 and next(self._seen) % self.sample:
+            return
+        offset = (next(self._index) % self.capacity) * _RECORD_SIZE
+        length = len(data)
+        _RECORD_HEADER.pack_into(self.buffer, offset, monotonic(), direction, source, length)
+        if length > _MAX_DATA:
+            data = data[:_MAX_DATA]
+            length = _MAX_DATA
+        offset += _RECORD_HEADER.size
+        self.buffer[offset:offset + length] = data
+
+    def records(self):
+        # The records in the buffer, oldest first, as (clock, direction, source, length, data)
+        buffer = str(self.buffer) # Snapshot, as other threads keep recording
+        records = []
+        for offset in xrange(0, len(buffer), _RECORD_SIZE):
+            clock, direction, source, length = _RECORD_HEADER.unpack_from(buffer, offset)
+            if not clock: # Never used
+                continue
+            start = offset + _RECORD_HEADER.size
+            records.append((clock, direction, source, length, buffer[start:start + min(length, _MAX_DATA)]))
+        records.sort()
+        return records
+
+    def dump(self, name):
+        records = self.records()
+        with open(name, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(_FILE_HEADER.pack(time.time() - monotonic(), len(self.sources), _RECORD_SIZE))
+            for label in self.sources:
+                f.write(chr(len(label)) + label)
+            for clock, direction, source, length, data in records:
+                f.write(_RECORD_HEADER.pack(clock, direction, source, length) + data.ljust(_MAX_DATA, '\x00'))
+        self.logger.info('dumped %d packets to %s', len(records), name)
+
+def read_dump(name):
+    # Yields (time, direction, source label, length, data) for each record in a dump
+    with open(name, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('%s is not a packet trace' % name)
+        offset, source_count, record_size = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+        sources = []
+        for i in xrange(source_count):
+            sources.append(f.read(ord(f.read(1))))
+        while True:
+            record = f.read(record_size)
+            if len(record) < record_size:
+                return
+            clock, direction, source, length = _RECORD_HEADER.unpack_from(record)
+            label = sources[source] if source < len(sources) else '?'
+            yield (clock + offset, direction, label, length, record[_RECORD_HEADER.size:_RECORD_HEADER.size + min(length, _MAX_DATA)])
+
+_tracer = None
+_stage_timing = False
+
+def tracer():
+    # The tracer sockets record to, or None if tracing is off
+    return _tracer
+
+def set_tracer(packet_tracer):
+    global _tracer
+
+    _tracer = packet_tracer
+
+def stage_timing():
+    # Whether connections opened from now on timestamp packets at each stage
+    return _stage_timing
+
+def set_stage_timing(enabled):
+    global _stage_timing
+
+    _stage_timing = enabled
+
+def add_trace_arguments(parser):
+    parser.add_argument('--trace', default=None, type=int, metavar='N', help='trace one in every N packets sent or received (dump with SIGUSR1)')
+    parser.add_argument('--trace-stream', default=None, type=int, metavar='STREAM_ID', help='trace only the voice packets of this stream')
+    parser.add_argument('--trace-size', default=4096, type=int, metavar='PACKETS', help='packets to keep in the trace buffer (default: 4096)')
+    parser.add_argument('--trace-file', default=None, help='where to dump the trace (default: pydv-<pid>.trace)')
+    parser.add_argument('--trace-stages', default=False, action='store_true', help='time each stage packets go through, from the socket to the application, and report latency percentiles on exit')
+
+def setup_tracing(args):
+    # Starts tracing if asked to by the arguments, before any sockets are opened
+    set_stage_timing(args.trace_stages)
+    if args.trace is None and args.trace_stream is None:
+        return None
+    packet_tracer = PacketTracer(args.trace_size, args.trace or 1, args.trace_stream)
+    name = args.trace_file or 'pydv-%d.trace' % os.getpid()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: packet_tracer.dump(name))
+    set_tracer(packet_tracer)
+    return packet_tracer
+
+def dv_trace():
+    parser = argparse.ArgumentParser(description='D-STAR packet trace printer. Prints packets dumped by the tracer of another utility.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-s', '--stream', default=None, type=int, help='print only the voice packets of this stream')
+    parser.add_argument('input', help='input file (trace)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    try:
+        for clock, direction, label, length, data in read_dump(args.input):
+            if args.stream is not None and stream_id_of(data) != args.stream:
+                continue
+            print '%s.%06d %s %-3s %4d %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(clock)), int((clock % 1) * 1000000),
+                                               label, 'out' if direction == TRACE_OUT else 'in', length, binascii.hexlify(data))
+    except (IOError, ValueError) as e:
+        logger.error('can not read %s: %s', args.input, str(e))
+        sys.exit(1)
+
+def main():
+    try:
+        dv_trace()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -18,48 +18,40 @@ import os
 import sys
 import argparse
 import logging
-
-from time import sleep
+import time
+import threading
+import multiprocessing
+import Queue
 
 from dstar import DSTARCallsign
-from ambed import AMBEdCodec, AMBEdFrameInPacket, AMBEdFrameOutPacket, AMBEdConnection
+from ambed import AMBEdCodec, AMBEdConnection, AMBEdServer, AMBEdScheduler
+from exporter import MetricsExporter
 from stream import DisconnectedError, DVHeaderPacket, DVFramePacket
 from network import NetworkAddress
 from dvtool import DVToolFile
+from vocoder import Vocoder, AMBE_SILENCE, FRAMES_PER_SUPERFRAME, DVDecoder, DVEncoder, superframe_chunks, vocoder_from_flag, vocoder_flag, vocoder_description
 
-def dv_transcoder():
-    parser = argparse.ArgumentParser(description='D-STAR transcoder. Connects to an AMBEd server to transcode recordings.')
-    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
-    parser.add_argument('callsign', help='your callsign')
-    parser.add_argument('address', help='AMBEd\'s hostname or IP address')
-    parser.add_argument('input', help='name of file to transcode (DVTool format)')
-    parser.add_argument('output', help='name of file to write (DVTool format)')
-    args = parser.parse_args()
-
-    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S',
-                        level=logging.DEBUG if args.verbose else logging.INFO)
-    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+def fill_missing(results, codec_out):
+    # Conceal frames that got no reply by repeating the previous one (or silence at the start)
+    frames = []
+    previous = AMBE_SILENCE if codec_out == AMBEdCodec.AMBEPLUS else '\x00' * 9
+    missing = 0
+    for frame_out in results:
+        if frame_out is None:
+            missing += 1
+        else:
+            previous = frame_out.data1 if frame_out.codec1 == codec_out else frame_out.data2
+        frames.append(previous)
+    return frames, missing
 
-    try:
-        callsign = DSTARCallsign(args.callsign)
-        address = NetworkAddress(args.address, AMBEdConnection.DEFAULT_PORT)
-    except ValueError:
-        parser.print_help()
-        sys.exit(1)
-
-    try:
-        with DVToolFile(args.input) as f:
-            stream = f.read()
-    except Exception as e:
-        raise
-        logger.error(str(e))
-        sys.exit(1)
+def read_stream(name):
+    # Returns the stream, with the header updated for the target vocoder, and the AMBEd codecs to use
+    with DVToolFile(name) as f:
+        stream = f.read()
 
     header = stream[0]
     if not isinstance(header, DVHeaderPacket):
-        logger.error('first packet in stream is not a header')
-        sys.exit(1)
+        raise ValueError('first packet in stream is not a header')
 
     # Determine vocoder (SV9OAN extension)
     version = header.dstar_header.flag_3 & 0xff
@@ -67,51 +59,270 @@ def dv_transcoder():
         codec_in = AMBEdCodec.AMBEPLUS
         codec_out = AMBEdCodec.CODEC2_3200
         header.dstar_header.flag_3 = 0x01
-        logger.info('stream encoded with AMBE vocoder')
     elif version & 0x03 == 0x01:
         codec_in = AMBEdCodec.CODEC2_3200
         codec_out = AMBEdCodec.AMBEPLUS
         header.dstar_header.flag_3 = 0
-        logger.info('stream encoded with Codec 2 vocoder (mode: 3200, fec: off)')
     elif version & 0x03 == 0x03:
         codec_in = AMBEdCodec.CODEC2_2400
         codec_out = AMBEdCodec.AMBEPLUS
         header.dstar_header.flag_3 = 0
-        logger.info('stream encoded with Codec 2 vocoder (mode: 2400, fec: on)')
     else:
-        logger.error('unrecognized flag in stream header')
+        raise ValueError('unrecognized flag in stream header')
+    return stream, codec_in, codec_out
+
+def transcode_stream(scheduler, stream, codec_in, codec_out, window=32, timeout=1):
+    # Returns the number of frames that got no reply, or None if the stream could not be transcoded.
+    # If a server fails during the job, the job is repeated on a newly opened stream on another one
+    # (or on the same one, once it is no longer skipped, if all have failed), and given up after
+    # failing on as many new streams as there are servers (at least two). If a reused stream fails,
+    # the server has probably dropped it, so the job is repeated on a newly opened stream.
+    # Servers that are being skipped after failing (i.e., in another job) are waited for.
+    packets = [packet for packet in stream if isinstance(packet, DVFramePacket)]
+    tried = []
+    reuse = True
+    attempts = max(len(scheduler.servers), 2)
+    while True:
+        server, transcoder = scheduler.acquire(codec_in, tried, reuse, wait=True)
+        if server is None:
+            return None
+        healthy = False
+        start_time = time.time()
+        try:
+            results = transcoder.transcode([packet.dstar_frame.dvcodec for packet in packets],
+                                           window=window,
+                                           timeout=timeout)
+            frames, missing = fill_missing(results, codec_out)
+            # Many missing replies mean the server has probably dropped the stream
+            healthy = missing * 10 <= len(packets)
+        finally:
+            scheduler.release(server, transcoder, healthy, len(packets), time.time() - start_time)
+        if healthy:
+            break
+        reuse = False
+        if transcoder.reused:
+            continue
+        attempts -= 1
+        if not attempts:
+            return None
+        tried.append(server)
+        if len(tried) >= len(scheduler.servers):
+            tried = []
+    for packet, dvcodec in zip(packets, frames):
+        packet.dstar_frame.dvcodec = dvcodec
+    return missing
+
+def _transcode_chunk(args):
+    vocoder_in, vocoder_out, frames, warmup = args
+    decoder = DVDecoder(vocoder_in)
+    encoder = DVEncoder(vocoder_out)
+    # Both vocoder states converge over the overlapping frames, whose output is dropped
+    result = [encoder.encode(decoder.decode(dvcodec)) for dvcodec in frames]
+    return result[warmup:]
+
+class LocalTranscoder(object):
+    # Transcode to Codec 2 in-process (i.e., decode AMBE with mbelib and encode with codec2),
+    # splitting streams at superframe boundaries and spreading the chunks over a process pool.
+    def __init__(self, vocoder_out, jobs=None, chunk_size=10 * FRAMES_PER_SUPERFRAME, overlap=FRAMES_PER_SUPERFRAME):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.vocoder_out = vocoder_out
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.pool = multiprocessing.Pool(jobs)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def transcode(self, streams):
+        # Transcode several streams at once (in place), so short streams also keep all processes busy
+        tasks = []
+        task_packets = []
+        for stream in streams:
+            header = stream[0]
+            vocoder_in = vocoder_from_flag(header.dstar_header.flag_3)
+            header.dstar_header.flag_3 = vocoder_flag(self.vocoder_out)
+            packets = [packet for packet in stream if isinstance(packet, DVFramePacket)]
+            frames = [packet.dstar_frame.dvcodec for packet in packets]
+            for warmup_start, start, end in superframe_chunks([packet.packet_id for packet in packets], self.chunk_size, self.overlap):
+                tasks.append((vocoder_in, self.vocoder_out, frames[warmup_start:end], start - warmup_start))
+                task_packets.append(packets[start:end])
+
+        for packets, frames in zip(task_packets, self.pool.imap(_transcode_chunk, tasks)):
+            for packet, dvcodec in zip(packets, frames):
+                packet.dstar_frame.dvcodec = dvcodec
+
+def dv_transcoder_local(args, logger):
+    vocoder_out = Vocoder.CODEC2_3200 if args.mode == '3200' else Vocoder.CODEC2_2400
+    logger.info('transcoding locally to %s', vocoder_description(vocoder_out))
+    pairs = zip(args.files[::2], args.files[1::2])
+    batch_size = 4 * (args.jobs or multiprocessing.cpu_count())
+    failed = False
+    try:
+        with LocalTranscoder(vocoder_out, args.jobs) as transcoder:
+            for i in xrange(0, len(pairs), batch_size):
+                batch = []
+                for input_name, output_name in pairs[i:i + batch_size]:
+                    try:
+                        with DVToolFile(input_name) as f:
+                            stream = f.read()
+                        if not isinstance(stream[0], DVHeaderPacket):
+                            raise ValueError('first packet in stream is not a header')
+                        vocoder_from_flag(stream[0].dstar_header.flag_3)
+                    except Exception as e:
+                        logger.error('can not read %s: %s', input_name, str(e) or 'unrecognized flag in stream header')
+                        failed = True
+                        continue
+                    batch.append((stream, output_name))
+
+                start_time = time.time()
+                transcoder.transcode([stream for stream, _ in batch])
+                elapsed = time.time() - start_time
+                frame_count = sum([len(stream) - 1 for stream, _ in batch])
+                logger.info('transcoded %d files, %d frames in %.3f seconds (%.1fx real time)',
+                            len(batch), frame_count, elapsed, (frame_count * 0.02) / elapsed if elapsed else float('inf'))
+
+                for stream, output_name in batch:
+                    with DVToolFile(output_name) as f:
+                        f.write(stream)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+def parse_servers(value, callsign):
+    # Comma-separated list of host[:capacity]
+    servers = []
+    for item in value.split(','):
+        host, _, capacity = item.partition(':')
+        capacity = int(capacity) if capacity else 1
+        if not host or capacity < 1:
+            raise ValueError
+        connection = AMBEdConnection(callsign, NetworkAddress(host, AMBEdConnection.DEFAULT_PORT))
+        servers.append(AMBEdServer(connection, capacity))
+    return servers
+
+def dv_transcoder():
+    parser = argparse.ArgumentParser(description='D-STAR transcoder. Connects to an AMBEd server to transcode recordings.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='enable debug output')
+    parser.add_argument('-w', '--window', default=32, type=int, help='maximum number of frames in flight (1-128)')
+    parser.add_argument('-t', '--timeout', default=1.0, type=float, help='seconds to wait for a transcoded frame')
+    parser.add_argument('--metrics-port', default=None, type=int, help='serve metrics in the Prometheus text format at this port on localhost')
+    parser.add_argument('-j', '--jobs', default=None, type=int, help='number of files to transcode concurrently (default: total server capacity, or number of CPUs when local)')
+    parser.add_argument('-m', '--mode', default='3200', help='vocoder mode when local (3200: Codec 2 mode 3200, 2400: Codec 2 mode 2400 with FEC)')
+    parser.add_argument('callsign', help='your callsign')
+    parser.add_argument('address', help='AMBEd\'s hostname or IP address, or a comma-separated list of servers to balance load over, each followed by :N for N hardware vocoders, or local to transcode to Codec 2 without AMBEd')
+    parser.add_argument('files', nargs='+', metavar='input output', help='names of files to transcode and write (DVTool format), in pairs')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)7s] %(name)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger(os.path.basename(sys.argv[0]))
+
+    try:
+        callsign = DSTARCallsign(args.callsign)
+        servers = parse_servers(args.address, callsign) if args.address != 'local' else []
+        if args.mode not in ('3200', '2400'):
+            raise ValueError
+        if not (0 < args.window <= 128) or args.timeout <= 0 or len(args.files) % 2 != 0 or (args.jobs is not None and args.jobs < 1):
+            raise ValueError
+    except ValueError:
+        parser.print_help()
         sys.exit(1)
 
+    if args.address == 'local':
+        dv_transcoder_local(args, logger)
+        return
+
+    jobs = Queue.Queue()
+    for input_name, output_name in zip(args.files[::2], args.files[1::2]):
+        jobs.put((input_name, output_name))
+    failures = []
+
+    def worker(scheduler):
+        while True:
+            try:
+                input_name, output_name = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                stream, codec_in, codec_out = read_stream(input_name)
+            except Exception as e:
+                logger.error('can not read %s: %s', input_name, str(e))
+                failures.append(input_name)
+                continue
+
+            frame_count = len(stream) - 1
+            start_time = time.time()
+            try:
+                missing = transcode_stream(scheduler, stream, codec_in, codec_out, args.window, args.timeout)
+            except DisconnectedError:
+                missing = None
+            elapsed = time.time() - start_time
+            if missing is None:
+                logger.error('can not transcode %s', input_name)
+                failures.append(input_name)
+                continue
+            logger.info('transcoded %d frames from %s in %.3f seconds (%.1fx real time), %d frames got no reply',
+                        frame_count, input_name, elapsed, (frame_count * 0.02) / elapsed if elapsed else float('inf'), missing)
+
+            try:
+                with DVToolFile(output_name) as f:
+                    f.write(stream)
+            except Exception as e:
+                logger.error('can not write %s: %s', output_name, str(e))
+                failures.append(input_name)
+
     try:
-        with AMBEdConnection(callsign, address) as conn:
+        with MetricsExporter(args.metrics_port) as exporter, AMBEdScheduler(servers) as scheduler:
+            def collect(metrics):
+                metrics.add('pydv_transcoder_jobs_pending', 'gauge', 'Files waiting to be transcoded', jobs.qsize())
+                metrics.add('pydv_transcoder_failures_total', 'counter', 'Files that could not be transcoded', len(failures))
+                for server in scheduler.servers:
+                    labels = {'server': str(server)}
+                    metrics.add_connection(server.connection.stats(), labels)
+                    metrics.add('pydv_ambed_active_streams', 'gauge', 'Transcoding streams in use', server.active, labels)
+                    metrics.add('pydv_ambed_jobs_total', 'counter', 'Jobs transcoded', server.jobs, labels)
+                    metrics.add('pydv_ambed_frames_total', 'counter', 'Frames transcoded', server.frames, labels)
+                    metrics.add('pydv_ambed_busy_seconds_total', 'counter', 'Time spent transcoding', server.busy_time, labels)
+                    metrics.add('pydv_ambed_consecutive_failures', 'gauge', 'Failures since the server last worked', server.failures, labels)
+                    metrics.add('pydv_ambed_stream_pool_hits_total', 'counter', 'Transcoding streams reused', server.pool.hits, labels)
+                    metrics.add('pydv_ambed_stream_pool_misses_total', 'counter', 'Transcoding streams opened', server.pool.misses, labels)
+                    metrics.add('pydv_ambed_rtt_seconds', 'gauge', 'Last AMBEd ping round trip time', server.pool.rtt, labels)
+            exporter.register(collect)
+
+            threads = [threading.Thread(target=worker, args=(scheduler,), name='TranscoderWorker-%d' % i)
+                       for i in xrange(args.jobs or scheduler.capacity)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
             try:
-                with conn.get_stream(codec_in) as transcoder:
-                    # Send it all, as AMBEd requires several packets available
-                    # before starting to send to the hardware devices.
-                    # Replies will be buffered in the stream's incoming queue anyway.
-                    for packet in stream:
-                        if not isinstance(packet, DVFramePacket):
-                            continue
-                        frame_in = AMBEdFrameInPacket(packet.packet_id, codec_in, packet.dstar_frame.dvcodec)
-                        transcoder.write(frame_in)
-                        sleep(0.02)
-
-                    for packet in stream:
-                        if not isinstance(packet, DVFramePacket):
-                            continue
-                        frame_out = transcoder.read()
-                        if not isinstance(frame_out, AMBEdFrameOutPacket):
-                            # raise ValueError('not enough transcoded frames')
-                            break
-                        packet.dstar_frame.dvcodec = frame_out.data1 if frame_out.codec1 == codec_out else frame_out.data2
-            except (DisconnectedError, KeyboardInterrupt):
+                while any([thread.is_alive() for thread in threads]):
+                    for thread in threads:
+                        thread.join(0.1)
+            except KeyboardInterrupt:
                 pass
-            else:
-                with DVToolFile(args.output) as f:
-                    f.write(stream)
+            for server in scheduler.servers:
+                logger.info('server %s: %d jobs, %d frames, %.1f frames/sec, busy rate %.1f%%, ping %s, stream pool hit rate %.1f%%, %.3f seconds of handshakes saved',
+                            server, server.jobs, server.frames, server.throughput, server.busy_rate * 100,
+                            '%.1f ms' % (server.pool.rtt * 1000) if server.pool.rtt is not None else 'n/a',
+                            server.pool.hit_rate * 100, server.pool.handshake_time_saved)
     except Exception as e:
         logger.error(str(e))
         sys.exit(1)
+    if failures:
+        sys.exit(1)
 
 def main():
     dv_transcoder()
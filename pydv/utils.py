@@ -14,6 +14,43 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import sys
+import time
+
+def _monotonic_clock():
+    # Python 2.7 has no time.monotonic, so call clock_gettime(CLOCK_MONOTONIC) directly
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform.startswith('linux'):
+        clock_id = 1
+    elif sys.platform == 'darwin':
+        clock_id = 6
+    else:
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        if clock_gettime(clock_id, ctypes.byref(timespec())) != 0:
+            return time.time
+    except Exception:
+        return time.time
+
+    def monotonic():
+        value = timespec() # Not shared, as other threads may run during the call
+        clock_gettime(clock_id, ctypes.byref(value))
+        return value.tv_sec + value.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds from an arbitrary point, not affected by system clock changes (use only for intervals)
+monotonic = _monotonic_clock()
+
 def or_valueerror(condition):
     if not condition:
         raise ValueError
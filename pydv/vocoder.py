@@ -0,0 +1,175 @@
+# Copyright (C) 2019 Antony Chazapis SV9OAN
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import struct
+
+from utils import or_valueerror
+
+# No Enum available in Python 2.7
+class Vocoder:
+    AMBE = 0
+    CODEC2_3200 = 1
+    CODEC2_2400 = 2
+
+FRAMES_PER_SUPERFRAME = 21
+
+AMBE_SILENCE = '\x9e\x8d\x32\x88\x26\x1a\x3f\x61\xe8'
+
+def superframe_chunks(packet_ids, chunk_size, overlap):
+    # Split frames for independent processing, returning (warmup_start, start, end) for each chunk.
+    # Only split where a superframe starts (the sync frame has packet_id 0), so that chunks stay
+    # aligned even if frames were lost. Frames from warmup_start to start are processed only to
+    # let the vocoder state converge.
+    boundaries = [0]
+    for i, packet_id in enumerate(packet_ids):
+        if (packet_id & 0x1f) == 0 and i - boundaries[-1] >= chunk_size:
+            boundaries.append(i)
+    boundaries.append(len(packet_ids))
+    return [(max(start - overlap, 0), start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+def vocoder_from_flag(flag_3):
+    # Determine vocoder (SV9OAN extension)
+    #
+    # The first bit controls the vocoder type:
+    #   0: AMBE (backwards compatible)
+    #   1: Codec 2
+    #
+    # The second bit differentiates between modes:
+    #   0: Codec 2 3200 (160 samples/20 ms into 64 bits)
+    #   1: Codec 2 2400 (160 samples/20 ms into 48 bits) + FEC (22 bits)
+    #
+    # With Codec 2 2400, we are protecting the first 24 bits of the
+    # voice datawith two applications of the (23, 12) Golay code.
+    version = flag_3 & 0xff
+    if version == 0:
+        return Vocoder.AMBE
+    if version & 0x03 == 0x01:
+        return Vocoder.CODEC2_3200
+    if version & 0x03 == 0x03:
+        return Vocoder.CODEC2_2400
+    raise ValueError
+
+def vocoder_flag(vocoder):
+    if vocoder == Vocoder.AMBE:
+        return 0
+    if vocoder == Vocoder.CODEC2_3200:
+        return 0x01
+    if vocoder == Vocoder.CODEC2_2400:
+        return 0x03
+    raise ValueError
+
+def vocoder_description(vocoder):
+    if vocoder == Vocoder.AMBE:
+        return 'AMBE vocoder'
+    return 'Codec 2 vocoder (mode: %s, fec: %s)' % ('2400' if vocoder == Vocoder.CODEC2_2400 else '3200',
+                                                   'on' if vocoder == Vocoder.CODEC2_2400 else 'off')
+
+class DVDecoder(object):
+    def __init__(self, vocoder):
+        or_valueerror(vocoder in (Vocoder.AMBE, Vocoder.CODEC2_3200, Vocoder.CODEC2_2400))
+        self.vocoder = vocoder
+        self.bit_count = 0
+        self.bit_errors = 0
+
+        if self.vocoder == Vocoder.AMBE:
+            import pydv.mbelib
+
+            self._mbelib = pydv.mbelib
+            self.state = pydv.mbelib.init_state()
+        else:
+            import pydv.codec2
+
+            self._codec2 = pydv.codec2
+            codec2_mode = pydv.codec2.CODEC2_MODE_2400 if self.vocoder == Vocoder.CODEC2_2400 else pydv.codec2.CODEC2_MODE_3200
+            self.state = pydv.codec2.codec2_create(codec2_mode)
+            if self.vocoder == Vocoder.CODEC2_2400:
+                pydv.codec2.golay23_init()
+
+    def _correct(self, dvcodec):
+        codec2 = self._codec2
+
+        received_codeword = ((ord(dvcodec[0]) << 15) |
+                             (((ord(dvcodec[1]) >> 4) & 0xF) << 11) |
+                             (ord(dvcodec[6]) << 3) |
+                             ((ord(dvcodec[7]) >> 5) & 0x7))
+        corrected_codeword = codec2.golay23_decode(received_codeword)
+        self.bit_count += 23
+        self.bit_errors += codec2.golay23_count_errors(received_codeword, corrected_codeword)
+
+        corrected_dvcodec = chr((corrected_codeword >> 15) & 0xFF)
+        partial_byte = ((corrected_codeword >> 11) & 0xF) << 4
+
+        received_codeword = (((ord(dvcodec[1]) & 0xF) << 19) |
+                             (ord(dvcodec[2]) << 11) |
+                             ((ord(dvcodec[7]) & 0x1F) << 6) |
+                             ((ord(dvcodec[8]) >> 2) & 0x3F))
+        corrected_codeword = codec2.golay23_decode(received_codeword)
+        self.bit_count += 23
+        self.bit_errors += codec2.golay23_count_errors(received_codeword, corrected_codeword)
+
+        corrected_dvcodec += chr(partial_byte | ((corrected_codeword >> 19) & 0xF))
+        corrected_dvcodec += chr((corrected_codeword >> 11) & 0xFF)
+
+        return corrected_dvcodec + dvcodec[3:]
+
+    def decode(self, dvcodec):
+        # Returns 160 samples (320 bytes of 16-bit little endian PCM)
+        if self.vocoder == Vocoder.AMBE:
+            samples = self._mbelib.decode_dstar(self.state, dvcodec)
+            return struct.pack('<160h', *samples)
+
+        if self.vocoder == Vocoder.CODEC2_2400:
+            dvcodec = self._correct(dvcodec)[:6]
+        else:
+            dvcodec = dvcodec[:8]
+        return self._codec2.codec2_decode(self.state, dvcodec)
+
+class DVEncoder(object):
+    # Only Codec 2 can be encoded locally
+    def __init__(self, vocoder):
+        or_valueerror(vocoder in (Vocoder.CODEC2_3200, Vocoder.CODEC2_2400))
+        self.vocoder = vocoder
+
+        import pydv.codec2
+
+        self._codec2 = pydv.codec2
+        codec2_mode = pydv.codec2.CODEC2_MODE_2400 if self.vocoder == Vocoder.CODEC2_2400 else pydv.codec2.CODEC2_MODE_3200
+        self.state = pydv.codec2.codec2_create(codec2_mode)
+        if self.vocoder == Vocoder.CODEC2_2400:
+            pydv.codec2.golay23_init()
+
+    def _protect(self, dvcodec):
+        codec2 = self._codec2
+
+        bits = (ord(dvcodec[0]) << 4) | ((ord(dvcodec[1]) >> 4) & 0xF)
+        codeword = codec2.golay23_encode(bits)
+        dvcodec += chr((codeword >> 3) & 0xFF)
+        partial_byte = (codeword & 0x7) << 5
+
+        bits = ((ord(dvcodec[1]) & 0xF) << 8) | ord(dvcodec[2])
+        codeword = codec2.golay23_encode(bits)
+        dvcodec += chr(partial_byte | ((codeword >> 6) & 0x1F))
+        dvcodec += chr((codeword & 0x3F) << 2)
+
+        return dvcodec
+
+    def encode(self, data):
+        # Expects 160 samples (320 bytes of 16-bit little endian PCM)
+        or_valueerror(len(data) == 320)
+        dvcodec = self._codec2.codec2_encode(self.state, data)
+        if self.vocoder == Vocoder.CODEC2_2400:
+            dvcodec = self._protect(dvcodec)
+        return dvcodec
@@ -21,7 +21,13 @@ setuptools.setup(
                                       'dv-player=pydv.player:main',
                                       'dv-encoder=pydv.encoder:main',
                                       'dv-decoder=pydv.decoder:main',
-                                      'dv-transcoder=pydv.transcoder:main']},
+                                      'dv-transcoder=pydv.transcoder:main',
+                                      'dv-monitor=pydv.monitor:main',
+                                      'dv-ambed=pydv.ambedserver:main',
+                                      'dv-reflector=pydv.reflector:main',
+                                      'dv-bridge=pydv.bridge:main',
+                                      'dv-trace=pydv.tracing:main',
+                                      'dv-replay=pydv.replay:main']},
     ext_modules=[setuptools.Extension(name='pydv.mbelib',
                                       sources=['pydv/mbelib.c'],
                                       libraries=['mbe']),